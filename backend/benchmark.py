@@ -0,0 +1,319 @@
+"""
+Offline benchmark for the formation pipeline.
+
+Renders a deterministic synthetic dance video with known dancer positions and
+depths, runs DanceFormationGenerator over it end to end, and prints a JSON
+report: throughput, per-stage latency, peak RSS and tracking accuracy
+(identity switches against the ground truth).
+
+With ``--models stub`` (the default) detection, depth and appearance
+embeddings come from lightweight stand-ins that read the synthetic frames
+directly, so the run needs no weights or network and measures the pipeline
+itself: decoding, batching, tracking and assignment. ``--models real`` uses
+the configured YOLO/MiDaS/embedder weights instead.
+
+    python benchmark.py --dancers 6 --seconds 30 --output bench.json
+"""
+import argparse
+import colorsys
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from inference import DetectionResult
+from main import DanceFormationGenerator
+from models import registry
+from timeline import UNSEEN_DEPTH
+
+# Ground-truth match radius, in normalized frame units, when scoring identities
+MATCH_DISTANCE = 0.08
+
+
+class SyntheticDance:
+    """
+    Deterministic synthetic performance: dancers hold a formation, then move
+    to the next one. Each dancer is a rectangle with its own hue; its size and
+    brightness grow with closeness to the camera.
+
+    Positions are normalized (x, y) centers in the frame, and depth is
+    ``0.3 + 0.7 * y`` (dancers lower in the frame are closer), so a larger
+    depth means closer, as with MiDaS.
+    """
+
+    def __init__(self, num_dancers, seconds, fps=30, width=960, height=540, seed=0, hold=2.0, move=1.5):
+        self.num_dancers = num_dancers
+        self.seconds = seconds
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.hold = hold
+        self.move = move
+        rng = np.random.default_rng(seed)
+        num_formations = int(np.ceil(seconds / (hold + move))) + 1
+        self.formations = rng.uniform(0.15, 0.85, size=(num_formations, num_dancers, 2))
+        self.colors = [
+            tuple(int(channel * 255) for channel in colorsys.hsv_to_rgb(i / num_dancers, 0.8, 1.0))[::-1]
+            for i in range(num_dancers)
+        ]
+
+    @property
+    def total_frames(self):
+        return int(round(self.seconds * self.fps))
+
+    def positions(self, t):
+        """
+        Returns:
+            np.ndarray: (num_dancers, 3) normalized x, y and depth at time t.
+        """
+        period = self.hold + self.move
+        index = min(int(t // period), len(self.formations) - 2)
+        progress = np.clip((t - index * period - self.hold) / self.move, 0.0, 1.0)
+        progress = progress * progress * (3 - 2 * progress)  # Ease in and out
+        xy = (1 - progress) * self.formations[index] + progress * self.formations[index + 1]
+        return np.column_stack([xy, 0.3 + 0.7 * xy[:, 1]])
+
+    def render(self, t):
+        frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        positions = self.positions(t)
+        # Far dancers first, so closer ones occlude them
+        for i in np.argsort(positions[:, 2]):
+            x, y, depth = positions[i]
+            box_height = (0.12 + 0.16 * depth) * self.height
+            box_width = 0.4 * box_height
+            x1, y1 = int(x * self.width - box_width / 2), int(y * self.height - box_height / 2)
+            x2, y2 = int(x * self.width + box_width / 2), int(y * self.height + box_height / 2)
+            color = tuple(int(channel * depth) for channel in self.colors[i])
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, thickness=-1)
+        return frame
+
+    def write(self, path):
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, (self.width, self.height))
+        if not writer.isOpened():
+            raise IOError(f"Cannot write video file {path}.")
+        try:
+            for index in range(self.total_frames):
+                writer.write(self.render(index / self.fps))
+        finally:
+            writer.release()
+
+
+class StubDetector:
+    """
+    YOLO stand-in: every bright connected blob on the black stage is a person.
+    Overlapping dancers merge into one blob, much like a real occlusion.
+    """
+
+    def __init__(self, threshold=40, min_area=100):
+        self.threshold = threshold
+        self.min_area = min_area
+
+    def __call__(self, frames, **kwargs):
+        results = []
+        for frame in frames:
+            mask = (frame.max(axis=2) > self.threshold).astype(np.uint8)
+            count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            boxes = [
+                (x, y, x + w, y + h)
+                for x, y, w, h, area in stats[1:count]
+                if area >= self.min_area
+            ]
+            xyxy = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+            results.append(DetectionResult(xyxy, np.full(len(xyxy), 0.9, dtype=np.float32)))
+        return results
+
+
+def stub_midas_transform(img, width=256):
+    """
+    MiDaS transform stand-in: downscale an RGB frame to a (1, 3, h, w) float tensor.
+    """
+    height = max(1, round(img.shape[0] * width / img.shape[1]))
+    resized = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    return torch.from_numpy(resized).permute(2, 0, 1).unsqueeze(0).float() / 255
+
+
+def stub_midas(batch):
+    """
+    MiDaS stand-in: brightness is depth, which is how SyntheticDance draws closeness.
+    """
+    return batch.amax(dim=1)
+
+
+class StubEmbedder:
+    """
+    Appearance embedder stand-in: a normalized hue histogram of each crop.
+    """
+
+    def __init__(self, bins=16):
+        self.bins = bins
+
+    def predict(self, crops):
+        embeddings = []
+        for crop in crops:
+            hsv = cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)
+            mask = (hsv[:, :, 2] > 40).astype(np.uint8)
+            histogram = cv2.calcHist([hsv], [0], mask, [self.bins], [0, 180]).ravel()
+            norm = np.linalg.norm(histogram)
+            embeddings.append(histogram / norm if norm else np.full(self.bins, 1 / np.sqrt(self.bins)))
+        return [embedding.astype(np.float32) for embedding in embeddings]
+
+
+def install_stub_models():
+    registry.override("yolo", StubDetector)
+    registry.override("midas", lambda: stub_midas)
+    registry.override("midas_transform", lambda: stub_midas_transform)
+    registry.override("embedder", StubEmbedder)
+
+
+def score_identities(entries, scene, match_distance=MATCH_DISTANCE):
+    """
+    Compare "coordinates" output entries with the ground truth.
+
+    At every entry, visible dancer numbers are matched to true dancers by
+    position. An identity switch is a true dancer being matched to a different
+    dancer number than the last time it was matched.
+
+    Returns:
+        dict: identity_switches, matched_fraction and mean_position_error (normalized units).
+    """
+    last_match = {}
+    switches = 0
+    matched = 0
+    errors = []
+    for entry in entries:
+        truth = scene.positions(entry["timestamp"])[:, :2]
+        coordinates = np.asarray(entry["coordinates"], dtype=np.float64)
+        visible = np.flatnonzero(coordinates[:, 2] != UNSEEN_DEPTH)
+        if not len(visible):
+            continue
+        distances = np.linalg.norm(coordinates[visible, None, :2] - truth[None, :, :], axis=2)
+        rows, cols = linear_sum_assignment(distances)
+        for row, col in zip(rows, cols):
+            if distances[row, col] > match_distance:
+                continue
+            dancer_num = int(visible[row]) + 1
+            if last_match.get(col, dancer_num) != dancer_num:
+                switches += 1
+            last_match[col] = dancer_num
+            matched += 1
+            errors.append(distances[row, col])
+    total = len(entries) * scene.num_dancers
+    return {
+        "identity_switches": switches,
+        "matched_fraction": matched / total if total else 0.0,
+        "mean_position_error": float(np.mean(errors)) if errors else None,
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(
+    scene,
+    video_path,
+    grid_size=15,
+    frame_interval=10,
+    batch_size=None,
+    inference_workers=None,
+    adaptive=None,
+    time_budget=None,
+):
+    """
+    Run the generator over a rendered scene and measure it.
+
+    Returns:
+        dict: Throughput, per-stage latency, peak RSS and accuracy.
+    """
+    generator = DanceFormationGenerator(scene.num_dancers, grid_size)
+    start = time.perf_counter()
+    entries = list(
+        generator.iter_position_matrices(
+            video_path,
+            frame_interval=frame_interval,
+            batch_size=batch_size,
+            inference_workers=inference_workers,
+            output_format="coordinates",
+            adaptive=adaptive,
+            time_budget=time_budget,
+        )
+    )
+    elapsed = time.perf_counter() - start
+    return {
+        "elapsed_seconds": elapsed,
+        "frames_per_second": scene.total_frames / elapsed if elapsed else None,
+        "entries": len(entries),
+        "stages": (generator.pipeline_stats or {}).get("stages", {}),
+        "queues": (generator.pipeline_stats or {}).get("queues", {}),
+        "peak_rss_mb": peak_rss_mb(),
+        "accuracy": score_identities(entries, scene),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the formation pipeline on a synthetic video.")
+    parser.add_argument("--dancers", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=540)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frame-interval", type=int, default=10)
+    parser.add_argument("--grid-size", type=int, default=15)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--inference-workers", type=int, default=None)
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, default=None)
+    parser.add_argument("--time-budget", type=float, default=None, help="Seconds allowed for the run (adaptive)")
+    parser.add_argument("--models", choices=("stub", "real"), default="stub")
+    parser.add_argument("--video", help="Reuse or keep the rendered video at this path")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    scene = SyntheticDance(args.dancers, args.seconds, args.fps, args.width, args.height, args.seed)
+    if args.models == "stub":
+        install_stub_models()
+    else:
+        registry.warm_up()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video or os.path.join(tmp_dir, "synthetic.mp4")
+        if not os.path.exists(video_path):
+            scene.write(video_path)
+        results = run_benchmark(
+            scene,
+            video_path,
+            grid_size=args.grid_size,
+            frame_interval=args.frame_interval,
+            batch_size=args.batch_size,
+            inference_workers=args.inference_workers,
+            adaptive=args.adaptive,
+            time_budget=args.time_budget,
+        )
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("video", "output")},
+        "video": {"frames": scene.total_frames, "fps": scene.fps, "width": scene.width, "height": scene.height},
+        "model_load_seconds": dict(registry.load_times),
+        **results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# Persistent cache of downloaded videos and computed position timelines
+CACHE_DIR = Path(os.environ.get("KADA_CACHE_DIR", Path(__file__).resolve().parent / "cache"))
+# Total size of cached files before least recently used entries are evicted
+CACHE_MAX_BYTES = int(os.environ.get("KADA_CACHE_MAX_BYTES", str(5 * 1024**3)))
+
+
+def digest(*parts):
+    """
+    Stable hex key for a tuple of JSON-serializable parts.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-link src to dst when possible so cache hits cost no I/O, else copy.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class DiskCache:
+    """
+    Content-addressed on-disk cache with size-based LRU eviction.
+
+    Entries live under ``root/<namespace>/<key><suffix>``. A file's mtime is its
+    last access time: reads touch it, and eviction removes the oldest files
+    until the cache fits in ``max_bytes``. Writes go through a temporary file
+    and ``os.replace`` so concurrent readers never see partial entries.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, namespace, key, suffix):
+        return self.root / namespace / f"{key}{suffix}"
+
+    def _hit(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _write(self, path, write):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def get_json(self, namespace, key):
+        path = self._hit(self._path(namespace, key, ".json"))
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+    def put_json(self, namespace, key, value):
+        self._write(self._path(namespace, key, ".json"), lambda f: f.write(json.dumps(value).encode()))
+
+    def get_file(self, namespace, key, suffix=""):
+        return self._hit(self._path(namespace, key, suffix))
+
+    def put_file(self, namespace, key, src_path, suffix=""):
+        """
+        Copy a file into the cache.
+
+        Returns:
+            Path: Location of the cached copy.
+        """
+        path = self._path(namespace, key, suffix)
+
+        def write(f):
+            with open(src_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+
+        self._write(path, write)
+        return path
+
+    def evict(self):
+        """
+        Delete least recently used files until the cache fits in max_bytes.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for path in self.root.glob("*/*"):
+                if path.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                logging.info(f"Evicted cache entry {path}")
+
+
+class FormationCache:
+    """
+    The two cache layers used by the server.
+
+    * query layer: (query, duration) -> resolved video ID and trimmed video file
+    * result layer: (source video, pipeline parameters, model versions, output format) -> position timeline
+
+    The source video is identified by video ID and duration when known, not by
+    the file's bytes: a streamed fragmented MP4 and its cached faststart remux
+    hold the same frames in different containers.
+    """
+
+    def __init__(self, disk_cache=None):
+        self.disk = disk_cache or DiskCache()
+
+    @staticmethod
+    def query_key(query, duration):
+        return digest(" ".join(query.lower().split()), duration)
+
+    @staticmethod
+    def video_key(video_id, duration):
+        return digest(video_id, duration)
+
+    def lookup_video(self, query, duration):
+        """
+        Returns:
+            tuple: (cached trimmed video Path, video ID) for the query, or (None, None)
+            unless both layers are still present.
+        """
+        entry = self.disk.get_json("queries", self.query_key(query, duration))
+        if entry is None:
+            return None, None
+        path = self.disk.get_file("videos", entry["video_key"], ".mp4")
+        return (path, entry["video_id"]) if path is not None else (None, None)
+
+    def store_video(self, query, duration, video_id, video_path):
+        video_key = self.video_key(video_id, duration)
+        self.disk.put_file("videos", video_key, video_path, ".mp4")
+        self.disk.put_json("queries", self.query_key(query, duration), {"video_id": video_id, "video_key": video_key})
+
+    @staticmethod
+    def result_key(video_source, num_dancers, grid_size, frame_interval, model_versions, output_format="matrix"):
+        return digest(video_source, num_dancers, grid_size, frame_interval, model_versions, output_format)
+
+    def lookup_result(self, result_key):
+        return self.disk.get_json("results", result_key)
+
+    def store_result(self, result_key, output_data):
+        self.disk.put_json("results", result_key, output_data)
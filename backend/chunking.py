@@ -0,0 +1,284 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from decoding import open_video
+from main import REATTACH_DISTANCE, DanceFormationGenerator, gated_assignment
+from metrics import STAGE_BUCKETS, Histogram
+
+# Length of the time chunks a long video is split into; 0 disables chunking
+CHUNK_SECONDS = float(os.environ.get("KADA_CHUNK_SECONDS", "30"))
+# Requests for at least this many seconds (or for the whole video) are chunked. The
+# choice depends on the request only, so a clip gets the same identities whether its
+# video came from the cache or a fresh download.
+CHUNK_MIN_DURATION = float(os.environ.get("KADA_CHUNK_MIN_DURATION", "300"))
+# Seconds each chunk re-processes from the end of the previous one. Identities are
+# matched across chunks in this window, so it must outlast tracker confirmation.
+CHUNK_OVERLAP = float(os.environ.get("KADA_CHUNK_OVERLAP", "4"))
+
+
+def chunk_settings():
+    """
+    Chunking settings that affect the output, for the result cache key.
+    """
+    return {"chunk_seconds": CHUNK_SECONDS, "chunk_overlap": CHUNK_OVERLAP, "chunk_min_duration": CHUNK_MIN_DURATION}
+
+
+def is_chunked(duration, min_duration=CHUNK_MIN_DURATION):
+    """
+    Whether a request for duration seconds (None for the whole video) is processed in chunks.
+    """
+    return bool(CHUNK_SECONDS) and (duration is None or duration >= min_duration)
+
+
+def plan_chunks(duration, chunk_seconds=CHUNK_SECONDS, overlap=CHUNK_OVERLAP):
+    """
+    Split [0, duration) into consecutive chunks.
+
+    A trailing piece shorter than the overlap is merged into the previous chunk,
+    since it could not be stitched reliably on its own.
+
+    Returns:
+        list: (start, end) pairs covering the video; end is None for the last chunk.
+    """
+    if not chunk_seconds or duration <= chunk_seconds + overlap:
+        return [(0.0, None)]
+    starts = np.arange(0.0, duration, chunk_seconds)
+    if len(starts) > 1 and duration - starts[-1] < overlap:
+        starts = starts[:-1]
+    ends = [float(start) for start in starts[1:]] + [None]
+    return [(float(start), end) for start, end in zip(starts, ends)]
+
+
+def plan_video_chunks(video_path, chunk_seconds=CHUNK_SECONDS, overlap=CHUNK_OVERLAP):
+    """
+    Chunk plan for a video file, from its decoded duration.
+    """
+    with open_video(video_path) as decoder:
+        duration = decoder.duration
+    return plan_chunks(duration, chunk_seconds, overlap)
+
+
+def process_chunk(video_path, num_dancers, grid_size, frame_interval, output_format, start_time, end_time):
+    """
+    Runs inside a worker process: track one chunk with its own generator and tracker.
+
+    Returns:
+        dict: "entries", the output entries with their "dancers" states from
+        start_time to end_time, and "stage_seconds", a stage latency histogram snapshot.
+    """
+    stage_seconds = Histogram("kada_stage_seconds", "", ("stage",), STAGE_BUCKETS)
+    generator = DanceFormationGenerator(num_dancers, grid_size)
+    generator.stage_hooks.append(lambda stage, elapsed: stage_seconds.observe(elapsed, stage=stage))
+    entries = list(
+        generator.iter_position_matrices(
+            video_path,
+            frame_interval=frame_interval,
+            output_format=output_format,
+            start_time=start_time,
+            end_time=end_time,
+            include_states=True,
+        )
+    )
+    return {"entries": entries, "stage_seconds": stage_seconds.snapshot()}
+
+
+def match_chunk_identities(overlap_entries, previous_states, last_positions, num_dancers, distance_threshold):
+    """
+    Map a chunk's dancer numbers onto the global ones.
+
+    Dancers are first matched on their mean grid distance across the timestamps
+    both chunks processed, gated by distance_threshold like reattachment in
+    DanceFormationGenerator. The rest are matched to the remaining global numbers
+    by distance to their last known position, then in number order.
+
+    Args:
+        overlap_entries (list): The chunk's entries inside the overlap window.
+        previous_states (dict): timestamp -> global "dancers" states of the previous chunk.
+        last_positions (dict): Global dancer number -> last known [grid_x, grid_y, depth].
+        num_dancers (int): Number of dancers.
+        distance_threshold (float): Largest mean grid distance accepted as the same dancer.
+
+    Returns:
+        dict: Local dancer number -> global dancer number, for every dancer.
+    """
+    numbers = range(1, num_dancers + 1)
+    distance_sums = np.zeros((num_dancers, num_dancers))
+    counts = np.zeros((num_dancers, num_dancers))
+    first_positions = {}
+    for entry in overlap_entries:
+        for local, state in entry["dancers"].items():
+            first_positions.setdefault(local, state)
+        previous = previous_states.get(entry["timestamp"])
+        if not previous:
+            continue
+        for local, state in entry["dancers"].items():
+            for dancer, previous_state in previous.items():
+                distance_sums[local - 1, dancer - 1] += np.hypot(
+                    state[0] - previous_state[0], state[1] - previous_state[1]
+                )
+                counts[local - 1, dancer - 1] += 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_distances = np.where(counts > 0, distance_sums / counts, np.inf)
+
+    mapping = {}
+    for row, col in gated_assignment(mean_distances, distance_threshold):
+        mapping[int(row) + 1] = int(col) + 1
+
+    unmatched = [local for local in numbers if local not in mapping]
+    free = [dancer for dancer in numbers if dancer not in mapping.values()]
+    candidates = [local for local in unmatched if local in first_positions]
+    targets = [dancer for dancer in free if dancer in last_positions]
+    if candidates and targets:
+        distances = np.array(
+            [
+                [
+                    np.hypot(
+                        first_positions[local][0] - last_positions[dancer][0],
+                        first_positions[local][1] - last_positions[dancer][1],
+                    )
+                    for dancer in targets
+                ]
+                for local in candidates
+            ]
+        )
+        for row, col in gated_assignment(distances, np.inf):
+            mapping[candidates[row]] = targets[col]
+
+    unmatched = [local for local in numbers if local not in mapping]
+    free = [dancer for dancer in numbers if dancer not in mapping.values()]
+    mapping.update(zip(unmatched, free))
+    return mapping
+
+
+def relabel_entry(entry, mapping, num_dancers):
+    """
+    Rewrite an entry's dancer numbers with mapping, in place.
+    """
+    if "position_matrix" in entry:
+        lookup = np.zeros(num_dancers + 1, dtype=np.int64)
+        for local, dancer in mapping.items():
+            lookup[local] = dancer
+        entry["position_matrix"] = lookup[np.asarray(entry["position_matrix"], dtype=np.int64)].tolist()
+    if "coordinates" in entry:
+        coordinates = list(entry["coordinates"])
+        for local, dancer in mapping.items():
+            coordinates[dancer - 1] = entry["coordinates"][local - 1]
+        entry["coordinates"] = coordinates
+    if "dancers" in entry:
+        entry["dancers"] = {mapping[local]: state for local, state in entry["dancers"].items()}
+    return entry
+
+
+def stitch_chunks(chunks, num_dancers, distance_threshold):
+    """
+    Join per-chunk entries into one timeline with consistent dancer numbers.
+
+    Args:
+        chunks (iterable): (start_time, entries) per chunk, in time order. Entries
+            before start_time are the overlap with the previous chunk.
+        num_dancers (int): Number of dancers.
+        distance_threshold (float): Largest mean grid distance accepted as the same dancer.
+
+    Yields:
+        dict: Output entries in time order, without the internal "dancers" states.
+    """
+    previous_states = {}
+    last_positions = {}
+    for index, (start_time, entries) in enumerate(chunks):
+        overlap = [entry for entry in entries if entry["timestamp"] < start_time]
+        if index:
+            mapping = match_chunk_identities(
+                overlap, previous_states, last_positions, num_dancers, distance_threshold
+            )
+            logging.info(f"Stitched chunk at {start_time:.1f}s with dancer mapping {mapping}.")
+        else:
+            mapping = {dancer: dancer for dancer in range(1, num_dancers + 1)}
+        previous_states = {}
+        for entry in entries:
+            if index and entry["timestamp"] < start_time:
+                continue
+            relabel_entry(entry, mapping, num_dancers)
+            dancers = entry.pop("dancers")
+            previous_states[entry["timestamp"]] = dancers
+            last_positions.update(dancers)
+            yield entry
+
+
+def iter_chunked_positions(
+    video_path,
+    num_dancers,
+    grid_size=15,
+    frame_interval=10,
+    output_format="matrix",
+    executor=None,
+    max_workers=None,
+    progress_callback=None,
+    stage_callback=None,
+    plan=None,
+    overlap=CHUNK_OVERLAP,
+):
+    """
+    Process a video as overlapping time chunks in parallel and yield stitched entries.
+
+    Each chunk runs in its own process with a fresh tracker, starting overlap
+    seconds before its nominal start. Entries are yielded in order as soon as
+    every earlier chunk has finished.
+
+    Args:
+        video_path (str): Path to the video file.
+        num_dancers (int): Number of dancers.
+        grid_size (int): Size of the position grid.
+        frame_interval (int): Emit an entry every frame_interval frames.
+        output_format (str): "matrix" or "coordinates".
+        executor (Executor or None): Process pool to run chunks on; a temporary one is created when None.
+        max_workers (int or None): Size of the temporary pool.
+        progress_callback (callable or None): Called as progress_callback(done_chunks, total_chunks).
+        stage_callback (callable or None): Called with each chunk's stage latency histogram snapshot.
+        plan (list or None): Chunks from plan_video_chunks; planned with the default settings when None.
+        overlap (float): Seconds shared by consecutive chunks.
+
+    Yields:
+        dict: Output entries, as produced by DanceFormationGenerator.iter_position_matrices.
+    """
+    if plan is None:
+        plan = plan_video_chunks(video_path, overlap=overlap)
+    logging.info(f"Processing video {video_path} in {len(plan)} chunks.")
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    futures = []
+    try:
+        for start, end in plan:
+            futures.append(
+                executor.submit(
+                    process_chunk,
+                    video_path,
+                    num_dancers,
+                    grid_size,
+                    frame_interval,
+                    output_format,
+                    max(0.0, start - overlap),
+                    end,
+                )
+            )
+
+        def completed_chunks():
+            for index, ((start, _), future) in enumerate(zip(plan, futures)):
+                chunk = future.result()
+                if progress_callback:
+                    progress_callback(index + 1, len(plan))
+                if stage_callback:
+                    stage_callback(chunk["stage_seconds"])
+                yield start, chunk["entries"]
+
+        yield from stitch_chunks(completed_chunks(), num_dancers, REATTACH_DISTANCE)
+    finally:
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,283 @@
+import io
+import logging
+import os
+import time
+from collections import namedtuple
+
+import cv2
+
+try:
+    import av
+except ImportError:  # PyAV is optional; OpenCV is always available
+    av = None
+
+# "auto" uses PyAV when installed, otherwise OpenCV
+VIDEO_DECODER = os.environ.get("KADA_VIDEO_DECODER", "auto")
+# Frames wider than this are scaled down while decoding; 0 keeps the source size.
+# The models work at ~256-640px, so full-res 1080p output is wasted work.
+DECODE_MAX_WIDTH = int(os.environ.get("KADA_DECODE_MAX_WIDTH", "960"))
+# Seconds a reader waits for a still-downloading file to grow before giving up
+INGEST_STALL_TIMEOUT = float(os.environ.get("KADA_INGEST_STALL_TIMEOUT", "60"))
+
+# A file is still being written while "<path>.partial" exists next to it; the marker
+# holds the expected duration in seconds, if known
+PARTIAL_SUFFIX = ".partial"
+# "<path>.failed" is left next to a file whose writer stopped before the end
+FAILED_SUFFIX = ".failed"
+
+# frame_count counts from 1 at the start of the video; timestamp is the frame's
+# presentation time in seconds; frame is a BGR ndarray
+DecodedFrame = namedtuple("DecodedFrame", ["frame_count", "timestamp", "frame"])
+
+
+def is_partial(video_path):
+    return os.path.exists(f"{video_path}{PARTIAL_SUFFIX}")
+
+
+def expected_duration(video_path):
+    """
+    Returns:
+        float or None: Final duration in seconds announced for a file still being written.
+    """
+    try:
+        with open(f"{video_path}{PARTIAL_SUFFIX}") as f:
+            return float(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def is_failed(video_path):
+    return os.path.exists(f"{video_path}{FAILED_SUFFIX}")
+
+
+def wait_complete(video_path, poll_interval=0.2):
+    """
+    Block until the writer of video_path has finished.
+
+    Returns:
+        bool: False if the writer failed, leaving the file truncated.
+    """
+    while is_partial(video_path):
+        time.sleep(poll_interval)
+    return not is_failed(video_path)
+
+
+class TailingFile(io.RawIOBase):
+    """
+    Sequential reader for a file that another process is still writing.
+
+    Reads at the end of the file wait for more data while the partial marker
+    exists, so a demuxer can consume a download as it arrives. The reader is
+    not seekable, which keeps FFmpeg from probing the (not yet written) end.
+    """
+
+    def __init__(self, path, poll_interval=0.05, stall_timeout=INGEST_STALL_TIMEOUT):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self._file = open(path, "rb", buffering=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        waited = 0.0
+        while True:
+            count = self._file.readinto(buffer)
+            if count:
+                return count
+            if not is_partial(self.path):
+                # The writer may have appended between our read and its exit
+                return self._file.readinto(buffer) or 0
+            if waited >= self.stall_timeout:
+                raise TimeoutError(f"No new data in {self.path} for {self.stall_timeout:.0f}s.")
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def scaled_size(width, height, max_width):
+    if not max_width or width <= max_width:
+        return width, height
+    # Keep dimensions even, as most codecs and scalers expect
+    return max_width, max(2, int(round(height * max_width / width / 2)) * 2)
+
+
+class VideoDecoder:
+    """
+    Base class for video decoding backends.
+
+    Subclasses open the video in ``__init__`` and set ``fps``, ``total_frames``,
+    ``width`` and ``height`` (of the output frames); ``iter_frames`` yields
+    DecodedFrame tuples with presentation timestamps.
+    """
+
+    fps = 0.0
+    total_frames = 0
+    width = 0
+    height = 0
+
+    def iter_frames(self, step=1, start_time=0.0, end_time=None):
+        """
+        Yield every step-th frame, counted from the start of the video.
+
+        Args:
+            step (int): Yield frames whose frame_count is a multiple of step.
+            start_time (float): Seek here (to the preceding keyframe, then decode forward) first.
+            end_time (float or None): Stop at the first frame at or after this time.
+
+        Yields:
+            DecodedFrame: Sampled frames in presentation order.
+        """
+        raise NotImplementedError
+
+    @property
+    def duration(self):
+        """
+        Length of the video in seconds, estimated from the frame count.
+        """
+        return self.total_frames / self.fps if self.fps else 0.0
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OpenCVDecoder(VideoDecoder):
+    """
+    cv2.VideoCapture backend. Skipped frames are grabbed without being converted,
+    and timestamps come from CAP_PROP_POS_MSEC rather than frame_count / fps.
+    """
+
+    def __init__(self, video_path, max_width=DECODE_MAX_WIDTH):
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise IOError(f"Cannot open video file {video_path}.")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        source_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        source_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.width, self.height = scaled_size(source_width, source_height, max_width)
+        self._resize = (self.width, self.height) != (source_width, source_height)
+
+    def iter_frames(self, step=1, start_time=0.0, end_time=None):
+        if start_time:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, start_time * 1000)
+        frame_count = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        while True:
+            frame_count += 1
+            if frame_count % step:
+                if not self.cap.grab():
+                    return
+                continue
+            ret, frame = self.cap.read()
+            if not ret:
+                return
+            timestamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if end_time is not None and timestamp >= end_time:
+                return
+            if self._resize:
+                frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+            yield DecodedFrame(frame_count, timestamp, frame)
+
+    def close(self):
+        self.cap.release()
+
+
+class PyAVDecoder(VideoDecoder):
+    """
+    PyAV (FFmpeg) backend with threaded codec decoding.
+
+    Sampled frames are scaled and converted to BGR in a single swscale pass, and
+    timestamps are the frames' true PTS, which stays correct on variable frame
+    rate sources. Seeking jumps to the preceding keyframe.
+
+    A file that is still being downloaded is read through TailingFile, so
+    decoding starts before the download ends; such files cannot be seeked,
+    and their frame count is estimated from the expected duration in the
+    partial marker (0 when unknown).
+    """
+
+    def __init__(self, video_path, max_width=DECODE_MAX_WIDTH):
+        if av is None:
+            raise ImportError("PyAV is not installed.")
+        self._source = TailingFile(video_path) if is_partial(video_path) else None
+        try:
+            self.container = av.open(self._source or video_path)
+        except Exception:
+            if self._source is not None:
+                self._source.close()
+            raise
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.fps = float(self.stream.average_rate or self.stream.guessed_rate or 0)
+        if self._source is not None:
+            # The header of a growing file only describes what was written so far
+            duration = expected_duration(video_path)
+            self.total_frames = int(duration * self.fps) if duration else 0
+        else:
+            self.total_frames = self.stream.frames or int(
+                float(self.container.duration or 0) / av.time_base * self.fps
+            )
+        self.width, self.height = scaled_size(
+            self.stream.codec_context.width, self.stream.codec_context.height, max_width
+        )
+
+    def iter_frames(self, step=1, start_time=0.0, end_time=None):
+        if start_time:
+            self.container.seek(int(start_time / self.stream.time_base), stream=self.stream, backward=True)
+        frame_count = None
+        for frame in self.container.decode(self.stream):
+            if frame.time is None:
+                continue
+            if frame.time < start_time:
+                continue
+            if end_time is not None and frame.time >= end_time:
+                return
+            # Frame numbers are anchored on the first frame's PTS so they stay
+            # consistent with the OpenCV backend after a seek
+            if frame_count is None:
+                frame_count = int(round(frame.time * self.fps)) + 1 if start_time else 1
+            else:
+                frame_count += 1
+            if frame_count % step:
+                continue
+            image = frame.to_ndarray(width=self.width, height=self.height, format="bgr24")
+            yield DecodedFrame(frame_count, frame.time, image)
+
+    def close(self):
+        self.container.close()
+        if self._source is not None:
+            self._source.close()
+
+
+def open_video(video_path, backend=VIDEO_DECODER, max_width=DECODE_MAX_WIDTH):
+    """
+    Open a video with the configured decoding backend.
+
+    Args:
+        video_path (str): Path or URL of the video.
+        backend (str): "pyav", "opencv" or "auto".
+        max_width (int): Output frame width cap; 0 keeps the source size.
+
+    Returns:
+        VideoDecoder: The opened decoder.
+    """
+    if backend == "pyav" or (backend == "auto" and av is not None):
+        try:
+            return PyAVDecoder(video_path, max_width)
+        except Exception as e:
+            if backend == "pyav":
+                raise
+            logging.warning(f"PyAV could not open {video_path} ({e}); falling back to OpenCV.")
+    # Only PyAV can read a file while it downloads; OpenCV waits for it to finish
+    wait_complete(video_path)
+    return OpenCVDecoder(video_path, max_width)
@@ -0,0 +1,384 @@
+"""
+ONNX Runtime inference for CPU deployments.
+
+With ``KADA_INFERENCE_BACKEND=onnx`` the model registry runs the YOLO detector
+and MiDaS through ONNX Runtime sessions instead of eager PyTorch. The graphs
+are exported from the eager models into the weights directory on first use
+(or ahead of time with ``python inference.py export``), and
+``KADA_ONNX_QUANTIZE=1`` switches to int8 dynamically quantized copies of them.
+
+Both wrappers keep the call conventions of the eager models, so the pipeline
+code does not change with the backend. Check a backend against the eager
+models on real footage before deploying it:
+
+    python inference.py compare dance.mp4 --frames 40 --quantize
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:  # Only needed for the onnx backend
+    onnxruntime = None
+
+INFERENCE_BACKENDS = ("torch", "onnx")
+
+YOLO_ONNX = "yolov8n.onnx"
+MIDAS_ONNX = "midas_v21_small_256.onnx"
+# Operator set of exported graphs
+ONNX_OPSET = 17
+# YOLOv8 input sides must be multiples of its largest stride
+YOLO_STRIDE = 32
+# Gray used by ultralytics to pad letterboxed inputs
+LETTERBOX_COLOR = (114, 114, 114)
+
+
+def quantized_name(name):
+    """
+    File name of the int8 copy of an exported graph.
+    """
+    return name.replace(".onnx", ".int8.onnx")
+
+
+def new_session(path, intra_op_threads=0, inter_op_threads=0):
+    """
+    CPU ONNX Runtime session with explicit thread pools.
+
+    Args:
+        intra_op_threads (int): Threads within an operator; 0 lets ONNX Runtime use every core.
+        inter_op_threads (int): Threads across independent operators; 0 keeps the default.
+    """
+    if onnxruntime is None:
+        raise ImportError("The onnx inference backend requires the onnxruntime package.")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    return onnxruntime.InferenceSession(str(path), sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def quantize(source, target):
+    """
+    Write an int8 copy of an ONNX graph with dynamically quantized weights.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(str(source), str(target), weight_type=QuantType.QUInt8)
+    logging.info(f"Quantized {source} to {target}")
+
+
+def export_yolo(yolo, path):
+    """
+    Export an ultralytics YOLO model to ONNX with dynamic batch and input size.
+    """
+    exported = yolo.export(format="onnx", dynamic=True, opset=ONNX_OPSET, simplify=False, verbose=False)
+    os.replace(exported, path)
+    logging.info(f"Exported YOLO to {path}")
+
+
+def export_midas(midas, path):
+    """
+    Export MiDaS to ONNX with dynamic batch and input size.
+    """
+    midas = midas.cpu().eval()
+    sample = torch.zeros(1, 3, 256, 256)
+    with torch.inference_mode():
+        torch.onnx.export(
+            midas,
+            sample,
+            str(path),
+            input_names=["image"],
+            output_names=["depth"],
+            dynamic_axes={"image": {0: "batch", 2: "height", 3: "width"}, "depth": {0: "batch", 1: "height", 2: "width"}},
+            opset_version=ONNX_OPSET,
+        )
+    logging.info(f"Exported MiDaS to {path}")
+
+
+class HostArray:
+    """
+    Array already on the host, with the ``cpu().numpy()`` accessors of a tensor.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class Boxes:
+    def __init__(self, xyxy, conf):
+        self.xyxy = HostArray(xyxy)
+        self.conf = HostArray(conf)
+
+
+class DetectionResult:
+    """
+    The part of an ultralytics ``Results`` the pipeline reads: ``boxes.xyxy`` and ``boxes.conf``.
+    """
+
+    def __init__(self, xyxy, conf):
+        self.boxes = Boxes(xyxy, conf)
+
+
+def letterbox(frames, imgsz):
+    """
+    Resize same-sized BGR frames so their longest side is imgsz and pad them
+    to the next multiple of the YOLO stride.
+
+    Returns:
+        tuple: (float32 RGB batch of shape (n, 3, h, w) in [0, 1], scale, (pad_x, pad_y)).
+    """
+    height, width = frames[0].shape[:2]
+    scale = imgsz / max(height, width)
+    resized_width, resized_height = max(1, round(width * scale)), max(1, round(height * scale))
+    padded_width = -(-resized_width // YOLO_STRIDE) * YOLO_STRIDE
+    padded_height = -(-resized_height // YOLO_STRIDE) * YOLO_STRIDE
+    pad_x, pad_y = (padded_width - resized_width) // 2, (padded_height - resized_height) // 2
+    batch = np.empty((len(frames), padded_height, padded_width, 3), dtype=np.uint8)
+    for image, frame in zip(batch, frames):
+        resized = cv2.resize(frame, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+        cv2.copyMakeBorder(
+            resized,
+            pad_y,
+            padded_height - resized_height - pad_y,
+            pad_x,
+            padded_width - resized_width - pad_x,
+            cv2.BORDER_CONSTANT,
+            dst=image,
+            value=LETTERBOX_COLOR,
+        )
+    # BGR to RGB and NHWC to NCHW in one copy
+    batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32) / 255
+    return batch, scale, (pad_x, pad_y)
+
+
+class OnnxYolo:
+    """
+    YOLOv8 detector on an exported ONNX graph, called like an ultralytics YOLO.
+
+    Preprocessing (letterbox) and postprocessing (best class over all classes,
+    confidence and class filters, per-class NMS, max_det, mapping boxes back to
+    the frame) follow ultralytics. Detections can still differ slightly from the
+    eager model: ultralytics resizes with its own rounding and may pad less, and
+    ONNX Runtime (especially int8) differs numerically, so check with
+    ``python inference.py compare``. Every frame of a call must have the same size.
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        self.session = new_session(path, intra_op_threads, inter_op_threads)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, frames, classes=None, conf=0.25, iou=0.7, imgsz=640, max_det=300, verbose=False):
+        if not len(frames):
+            return []
+        height, width = frames[0].shape[:2]
+        batch, scale, (pad_x, pad_y) = letterbox(frames, imgsz)
+        # (n, 4 + num_classes, num_anchors): cx, cy, w, h, then per-class scores
+        outputs = self.session.run(None, {self.input_name: batch})[0]
+        results = []
+        for output in outputs:
+            predictions = output.T
+            scores = predictions[:, 4:]
+            # Best class over all classes first, then the class filter, as ultralytics does:
+            # a box whose best class is not requested is dropped, not relabelled
+            class_ids = scores.argmax(axis=1)
+            confidences = scores[np.arange(len(scores)), class_ids]
+            keep = confidences > conf
+            if classes is not None:
+                keep &= np.isin(class_ids, list(classes))
+            xywh, confidences, class_ids = predictions[keep, :4], confidences[keep], class_ids[keep]
+            xyxy = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+            xyxy = (xyxy - [pad_x, pad_y, pad_x, pad_y]) / scale
+            xyxy = np.clip(xyxy, 0, [width, height, width, height]).astype(np.float32)
+            indices = self._nms(xyxy, confidences, class_ids, iou)[:max_det]
+            results.append(DetectionResult(xyxy[indices], confidences[indices].astype(np.float32)))
+        return results
+
+    @staticmethod
+    def _nms(xyxy, confidences, class_ids, iou):
+        if not len(xyxy):
+            return np.empty(0, dtype=int)
+        # Offset boxes per class so one NMS pass never suppresses across classes
+        offset = xyxy + class_ids[:, None] * (xyxy.max() + 1)
+        rects = np.column_stack([offset[:, :2], offset[:, 2:] - offset[:, :2]]).tolist()
+        indices = cv2.dnn.NMSBoxes(rects, confidences.tolist(), 0.0, iou)
+        indices = np.asarray(indices, dtype=int).reshape(-1)
+        return indices[np.argsort(-confidences[indices], kind="stable")]
+
+
+class OnnxMidas:
+    """
+    MiDaS on an exported ONNX graph, called like the eager model: a
+    (n, 3, h, w) tensor in, a (n, h, w) tensor of relative inverse depth out.
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        self.session = new_session(path, intra_op_threads, inter_op_threads)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_tensor):
+        image = input_tensor.detach().cpu().numpy().astype(np.float32, copy=False)
+        return torch.from_numpy(self.session.run(None, {self.input_name: image})[0])
+
+
+def compare_detections(reference, candidate, match_iou=0.5):
+    """
+    Match candidate boxes to reference boxes of the same frames.
+
+    Returns:
+        dict: recall and precision at match_iou, mean IoU and mean confidence
+        difference of matched boxes.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    matched, ious, confidence_deltas = 0, [], []
+    reference_total = candidate_total = 0
+    for ref, cand in zip(reference, candidate):
+        ref_boxes, cand_boxes = ref.boxes.xyxy.cpu().numpy(), cand.boxes.xyxy.cpu().numpy()
+        reference_total += len(ref_boxes)
+        candidate_total += len(cand_boxes)
+        if not len(ref_boxes) or not len(cand_boxes):
+            continue
+        top_left = np.maximum(ref_boxes[:, None, :2], cand_boxes[None, :, :2])
+        bottom_right = np.minimum(ref_boxes[:, None, 2:], cand_boxes[None, :, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+        ref_area = np.prod(ref_boxes[:, 2:] - ref_boxes[:, :2], axis=1)
+        cand_area = np.prod(cand_boxes[:, 2:] - cand_boxes[:, :2], axis=1)
+        overlap = intersection / (ref_area[:, None] + cand_area[None, :] - intersection + 1e-9)
+        rows, cols = linear_sum_assignment(-overlap)
+        ref_conf, cand_conf = ref.boxes.conf.cpu().numpy(), cand.boxes.conf.cpu().numpy()
+        for row, col in zip(rows, cols):
+            if overlap[row, col] >= match_iou:
+                matched += 1
+                ious.append(overlap[row, col])
+                confidence_deltas.append(abs(ref_conf[row] - cand_conf[col]))
+    return {
+        "reference_boxes": reference_total,
+        "candidate_boxes": candidate_total,
+        "recall": matched / reference_total if reference_total else None,
+        "precision": matched / candidate_total if candidate_total else None,
+        "mean_iou": float(np.mean(ious)) if ious else None,
+        "mean_confidence_delta": float(np.mean(confidence_deltas)) if confidence_deltas else None,
+    }
+
+
+def compare_depth(reference, candidate):
+    """
+    Compare raw MiDaS predictions after min-max normalizing each map, as the pipeline does.
+
+    Returns:
+        dict: Mean and max absolute difference of normalized maps, and mean Pearson correlation.
+    """
+    errors, max_errors, correlations = [], [], []
+    for ref, cand in zip(reference.numpy(), candidate.numpy()):
+        ref = (ref - ref.min()) / max(ref.max() - ref.min(), 1e-9)
+        cand = (cand - cand.min()) / max(cand.max() - cand.min(), 1e-9)
+        difference = np.abs(ref - cand)
+        errors.append(difference.mean())
+        max_errors.append(difference.max())
+        correlations.append(np.corrcoef(ref.ravel(), cand.ravel())[0, 1])
+    return {
+        "mean_abs_error": float(np.mean(errors)),
+        "max_abs_error": float(np.max(max_errors)),
+        "mean_correlation": float(np.nanmean(correlations)),
+    }
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def compare_backends(video_path, num_frames=20, batch_size=4, quantize=False):
+    """
+    Run the eager torch models and the ONNX Runtime backend on the same frames
+    of a video and report their agreement and per-frame latency.
+
+    Returns:
+        dict: "detection" and "depth" agreement, "latency_ms" per backend and model.
+    """
+    from decoding import open_video
+    from main import DETECTION_CONFIDENCE, DETECTION_IMGSZ, DETECTION_IOU, PERSON_CLASS
+    from models import ModelRegistry
+
+    with open_video(video_path) as decoder:
+        step = max(1, (decoder.total_frames or num_frames) // num_frames)
+        frames = [decoded.frame for decoded in itertools.islice(decoder.iter_frames(step), num_frames)]
+    if not frames:
+        raise ValueError(f"No frames decoded from {video_path}.")
+
+    registries = {
+        "torch": ModelRegistry(backend="torch"),
+        "onnx": ModelRegistry(backend="onnx", quantize=quantize),
+    }
+    detections, depths = {}, {}
+    latency = {name: {"detect": 0.0, "depth": 0.0} for name in registries}
+    for name, registry in registries.items():
+        yolo, midas, transform = registry.yolo, registry.midas, registry.midas_transform
+        # Untimed warm-up call, so one-off initialization is not counted
+        yolo(frames[:1], classes=[PERSON_CLASS], conf=DETECTION_CONFIDENCE, iou=DETECTION_IOU, imgsz=DETECTION_IMGSZ, verbose=False)
+        detections[name], depths[name] = [], []
+        for start in range(0, len(frames), batch_size):
+            batch = frames[start:start + batch_size]
+            results, elapsed = _timed(
+                yolo, batch, classes=[PERSON_CLASS], conf=DETECTION_CONFIDENCE, iou=DETECTION_IOU, imgsz=DETECTION_IMGSZ, verbose=False
+            )
+            detections[name].extend(results)
+            latency[name]["detect"] += elapsed
+            input_tensor = torch.cat([transform(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in batch])
+            with torch.inference_mode():
+                prediction, elapsed = _timed(midas, input_tensor.to(registry.device))
+            depths[name].append(prediction.float().cpu())
+            latency[name]["depth"] += elapsed
+    return {
+        "frames": len(frames),
+        "quantized": quantize,
+        "detection": compare_detections(detections["torch"], detections["onnx"]),
+        "depth": compare_depth(torch.cat(depths["torch"]), torch.cat(depths["onnx"])),
+        "latency_ms": {
+            name: {model: 1000 * seconds / len(frames) for model, seconds in timings.items()}
+            for name, timings in latency.items()
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export and check ONNX Runtime models.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export (and optionally quantize) the ONNX graphs into the weights directory")
+    export.add_argument("--quantize", action="store_true")
+    compare = commands.add_parser("compare", help="Compare the onnx backend with the eager torch models on a video")
+    compare.add_argument("video")
+    compare.add_argument("--frames", type=int, default=20)
+    compare.add_argument("--batch-size", type=int, default=4)
+    compare.add_argument("--quantize", action="store_true")
+    args = parser.parse_args(argv)
+
+    from models import ModelRegistry
+
+    if args.command == "export":
+        registry = ModelRegistry(backend="onnx", quantize=args.quantize)
+        registry.yolo
+        registry.midas
+    else:
+        print(json.dumps(compare_backends(args.video, args.frames, args.batch_size, args.quantize), indent=2))
+
+
+if __name__ == "__main__":
+    main()
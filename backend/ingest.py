@@ -0,0 +1,169 @@
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+import yt_dlp
+
+from decoding import FAILED_SUFFIX, PARTIAL_SUFFIX
+
+# Tallest video stream downloaded. Frames are scaled to DECODE_MAX_WIDTH for the
+# models anyway, so anything above this only costs bandwidth and decode time.
+INGEST_MAX_HEIGHT = int(os.environ.get("KADA_INGEST_MAX_HEIGHT", "720"))
+# Seconds ffmpeg waits on a stalled network read before failing the download
+INGEST_NETWORK_TIMEOUT = int(os.environ.get("KADA_INGEST_NETWORK_TIMEOUT", "30"))
+
+# Fragmented MP4 has no trailing index, so every finished fragment is decodable
+# (and playable) while later ones are still being written
+FRAGMENTED_MP4_FLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+
+def format_selector(max_height=INGEST_MAX_HEIGHT):
+    """
+    yt-dlp format selection preferring H.264 + AAC, which mux into MP4 without re-encoding.
+    """
+    cap = f"[height<={max_height}]"
+    return f"bestvideo{cap}[vcodec^=avc1]+bestaudio[ext=m4a]/best{cap}[ext=mp4]/bestvideo{cap}+bestaudio/best{cap}/best"
+
+
+def resolve_video(query, max_height=INGEST_MAX_HEIGHT):
+    """
+    Look up the first search result for query without downloading it.
+
+    Returns:
+        tuple: (video info dict, list of the selected format dicts: video then audio, or one muxed format).
+    """
+    ydl_opts = {
+        "format": format_selector(max_height),
+        "noplaylist": True,
+        "quiet": True,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        result = ydl.extract_info(f"ytsearch1:{query}", download=False)
+    video = result["entries"][0] if "entries" in result else result
+    return video, video.get("requested_formats") or [video]
+
+
+def ffmpeg_command(formats, duration, output_path):
+    """
+    Single-pass download: ffmpeg reads only the first duration seconds of each
+    selected stream and stream-copies them into fragmented MP4.
+    """
+    command = ["ffmpeg", "-y", "-loglevel", "error"]
+    for fmt in formats:
+        headers = "".join(f"{name}: {value}\r\n" for name, value in (fmt.get("http_headers") or {}).items())
+        if headers:
+            command += ["-headers", headers]
+        command += ["-rw_timeout", str(INGEST_NETWORK_TIMEOUT * 1_000_000)]
+        if duration is not None:
+            command += ["-t", str(duration)]
+        command += ["-i", fmt["url"]]
+    if len(formats) > 1:
+        command += ["-map", "0:v:0", "-map", "1:a:0"]
+    else:
+        command += ["-map", "0:v:0", "-map", "0:a:0?"]
+    command += ["-c", "copy", "-movflags", FRAGMENTED_MP4_FLAGS, "-f", "mp4", output_path]
+    return command
+
+
+def faststart_copy(video_path, directory=None):
+    """
+    Remux a finished download into a regular MP4 with the index at the front
+    (+faststart), which browsers can seek without scanning fragments.
+
+    Args:
+        directory (str or None): Where to write the copy; the system temp directory when None.
+
+    Returns:
+        str: Path of the temporary copy; the caller removes it.
+    """
+    fd, output_path = tempfile.mkstemp(suffix=".mp4", dir=directory)
+    os.close(fd)
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", str(video_path),
+        "-map", "0", "-c", "copy", "-movflags", "+faststart", output_path,
+    ]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except BaseException:
+        os.remove(output_path)
+        raise
+    return output_path
+
+
+class Download:
+    """
+    A video being written to disk by ffmpeg.
+
+    ``<path>.partial`` exists for as long as ffmpeg runs, which is how decoders
+    (possibly in other processes) know to keep reading as the file grows. It
+    holds expected_duration, from which readers estimate progress. If ffmpeg
+    fails, ``<path>.failed`` is created before the partial marker is removed.
+
+    A finished download is remuxed with +faststart in place before the marker
+    goes, so the file served as complete is always seekable. Readers that
+    opened the fragmented file keep reading it, as it is replaced, not rewritten.
+    """
+
+    def __init__(self, video_id, path, command, expected_duration=None):
+        self.video_id = video_id
+        self.path = path
+        self.marker = f"{path}{PARTIAL_SUFFIX}"
+        with open(self.marker, "w") as f:
+            if expected_duration:
+                f.write(str(expected_duration))
+        # Readers may open the file as soon as it exists; ffmpeg truncates it in place
+        open(path, "wb").close()
+        try:
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except BaseException:
+            os.remove(self.marker)
+            raise
+        self._watcher = threading.Thread(target=self._watch, name=f"download-{video_id}", daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        _, stderr = self.process.communicate()
+        if self.process.returncode:
+            logging.error(f"Download of {self.video_id} failed: {stderr.decode(errors='replace').strip()}")
+            open(f"{self.path}{FAILED_SUFFIX}", "w").close()
+        else:
+            self._faststart()
+        os.remove(self.marker)
+
+    def _faststart(self):
+        try:
+            remuxed = faststart_copy(self.path, directory=os.path.dirname(self.path))
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Could not remux {self.path} with faststart: {e}")
+            return
+        os.replace(remuxed, self.path)
+
+    def wait(self):
+        """
+        Block until the download ends.
+
+        Returns:
+            bool: True if ffmpeg wrote the whole requested range.
+        """
+        self._watcher.join()
+        return self.process.returncode == 0
+
+
+def start_download(query, duration, output_path, max_height=INGEST_MAX_HEIGHT):
+    """
+    Resolve the query and start downloading its first duration seconds (all of it when None).
+
+    Returns as soon as ffmpeg is running; decode output_path while it grows.
+
+    Returns:
+        Download: The running download.
+    """
+    video, formats = resolve_video(query, max_height)
+    format_ids = "+".join(str(fmt.get("format_id")) for fmt in formats)
+    logging.info(f"Downloading {video.get('id')} as format {format_ids} to {output_path}")
+    lengths = [length for length in (duration, video.get("duration")) if length]
+    return Download(
+        video.get("id"), output_path, ffmpeg_command(formats, duration, output_path), min(lengths, default=None)
+    )
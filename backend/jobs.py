@@ -0,0 +1,505 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cache import FormationCache, file_digest
+from chunking import chunk_settings, is_chunked, iter_chunked_positions, plan_video_chunks
+from decoding import is_partial, wait_complete
+from ingest import INGEST_MAX_HEIGHT
+from media import remove_media
+from main import DanceFormationAPI, pipeline_settings
+from metrics import STAGE_BUCKETS, Histogram, metrics
+from models import registry
+from profiling import PROFILERS, new_profiler
+
+# Worker processes running the formation pipeline
+JOB_WORKERS = int(os.environ.get("KADA_JOB_WORKERS", "2"))
+# Jobs allowed to wait for a free worker before new submissions are rejected
+MAX_QUEUED_JOBS = int(os.environ.get("KADA_MAX_QUEUED_JOBS", "16"))
+# Finished jobs kept in memory for status/result lookups
+MAX_FINISHED_JOBS = int(os.environ.get("KADA_MAX_FINISHED_JOBS", "256"))
+
+# Pipeline parameters used for every job; part of the result cache key
+GRID_SIZE = 15
+FRAME_INTERVAL = 10
+
+JOBS_SUBMITTED = metrics.counter("kada_jobs_submitted_total", "Jobs accepted into the queue.")
+JOBS_REJECTED = metrics.counter("kada_jobs_rejected_total", "Job submissions refused because the queue was full.")
+JOBS_FINISHED = metrics.counter("kada_jobs_finished_total", "Jobs that finished, by outcome.", ("status", "cached"))
+JOBS_PENDING = metrics.gauge("kada_jobs_pending", "Jobs queued, downloading or processing.")
+JOB_PHASE_SECONDS = metrics.histogram("kada_job_phase_seconds", "Wall time of each job phase.", ("phase",))
+STAGE_SECONDS = metrics.histogram(
+    "kada_stage_seconds", "Per-frame pipeline stage latency in the workers.", ("stage",), STAGE_BUCKETS
+)
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when the job queue has no room for another submission.
+    """
+
+
+# Why this worker process could not load its models at startup, if it could not
+_warm_up_error = None
+
+
+def _init_worker():
+    """
+    Process pool initializer: load every model before the worker takes a job.
+
+    Failures are logged and kept instead of raised, since an initializer that
+    raises breaks the whole pool; models still missing load on the first job.
+    """
+    global _warm_up_error
+    try:
+        registry.warm_up()
+    except Exception as e:
+        logging.exception("Model warm-up failed; models will be loaded by the first job.")
+        _warm_up_error = f"{type(e).__name__}: {e}"
+
+
+def _worker_load_times():
+    """
+    Raises:
+        RuntimeError: If this worker's warm-up failed.
+    """
+    if _warm_up_error is not None:
+        raise RuntimeError(_warm_up_error)
+    return dict(registry.load_times)
+
+
+def _process_job(
+    job_id, video_path, num_dancers, duration, grid_size, frame_interval, output_format, progress_queue, profile=None
+):
+    """
+    Runs inside a worker process. Progress and each position entry are streamed
+    back through progress_queue as they are computed.
+
+    Returns:
+        dict: "positions", the full entry list; "stage_seconds", a stage latency
+        histogram snapshot; and "profile", the report of the named profiler or None.
+    """
+    last_reported = 0.0
+
+    def report(frame_count, total_frames):
+        nonlocal last_reported
+        if total_frames <= 0:
+            return
+        progress = min(frame_count / total_frames, 1.0)
+        # Throttle cross-process messages to 1% steps
+        if progress - last_reported >= 0.01:
+            last_reported = progress
+            progress_queue.put((job_id, "progress", progress))
+
+    api = DanceFormationAPI(num_dancers, grid_size)
+    stage_seconds = Histogram(STAGE_SECONDS.name, "", ("stage",), STAGE_BUCKETS)
+    api.generator.stage_hooks.append(lambda stage, elapsed: stage_seconds.observe(elapsed, stage=stage))
+    profiler = new_profiler(profile) if profile else None
+    if profiler is not None:
+        api.generator.stage_hooks.append(profiler.on_stage)
+        profiler.start()
+    output_data = []
+    try:
+        entries = api.iter_positions(
+            video_path, frame_interval=frame_interval, progress_callback=report, output_format=output_format
+        )
+        for entry in entries:
+            output_data.append(entry)
+            progress_queue.put((job_id, "position", entry))
+    finally:
+        profile_report = profiler.stop() if profiler is not None else None
+    return {"positions": output_data, "stage_seconds": stage_seconds.snapshot(), "profile": profile_report}
+
+
+class Job:
+    """
+    State of one video processing request. Only touched from the event loop.
+    """
+
+    def __init__(self, query, num_dancers, duration, output_format="matrix", profile=None):
+        self.id = str(uuid.uuid4())
+        self.query = query
+        self.num_dancers = num_dancers
+        self.duration = duration
+        self.output_format = output_format
+        self.profile = profile  # Name of the profiler attached to this job, if any
+        self.profile_report = None
+        self.status = "queued"
+        self.progress = 0.0
+        self.video_path = None
+        self.result = None
+        self.positions = []  # Entries streamed from the worker so far
+        self.error = None
+        self.cached = False
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status in ("completed", "failed")
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.version += 1
+        # Wake everyone waiting on the current event, then arm a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, timeout=None):
+        """
+        Wait until the next update. Raises asyncio.TimeoutError after timeout seconds.
+        """
+        await asyncio.wait_for(self._changed.wait(), timeout)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "query": self.query,
+            "num_dancers": self.num_dancers,
+            "duration": self.duration,
+            "output_format": self.output_format,
+            "profile": self.profile,
+            "error": self.error,
+            "cached": self.cached,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs video processing jobs on a pool of pre-warmed worker processes.
+
+    Downloads happen on the event loop's thread pool; the CPU-bound formation
+    pipeline runs in a ProcessPoolExecutor so it never blocks the API. Worker
+    progress is forwarded to the event loop through a managed queue.
+    """
+
+    def __init__(self, prepare_video, num_workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS, cache=None):
+        """
+        Args:
+            prepare_video (coroutine function): (query, duration) -> (local video path, video ID);
+                the path is None if the video could not be fetched, the ID None if unknown.
+            num_workers (int): Worker processes running the pipeline.
+            max_queued (int): Jobs allowed to wait for a worker.
+            cache (FormationCache or None): Result cache consulted before running the pipeline.
+        """
+        self.prepare_video = prepare_video
+        self.cache = cache
+        self.num_workers = max(1, num_workers)
+        self.max_queued = max(0, max_queued)
+        self.jobs = OrderedDict()
+        self.executor = None
+        self._loop = None
+        self._manager = None
+        self._progress_queue = None
+        self._listener = None
+        self._warm_up_futures = []
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        JOBS_PENDING.set_function(self.pending_count)
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._progress_queue = self._manager.Queue()
+        self._start_executor()
+        self._listener = threading.Thread(target=self._listen_progress, name="job-progress", daemon=True)
+        self._listener.start()
+        logging.info(f"JobManager started with {self.num_workers} workers.")
+
+    def _start_executor(self):
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers, mp_context=context, initializer=_init_worker
+        )
+        # Spawn every worker now so models are warm before the first job arrives
+        self._warm_up_futures = [self.executor.submit(_worker_load_times) for _ in range(self.num_workers)]
+
+    def _restart_executor(self, broken):
+        """
+        Replace a pool that lost a worker process; later jobs would all fail on it.
+        """
+        if self.executor is not broken:
+            return  # Another job already replaced it
+        logging.error("A job worker process died; restarting the worker pool.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._start_executor()
+
+    async def shutdown(self):
+        if self._progress_queue is not None:
+            self._progress_queue.put(None)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+    @property
+    def ready(self):
+        return bool(self._warm_up_futures) and all(
+            future.done() and future.exception() is None for future in self._warm_up_futures
+        )
+
+    @property
+    def warm_up_errors(self):
+        """
+        Errors of workers that could not load their models at startup.
+        """
+        return [
+            str(future.exception())
+            for future in self._warm_up_futures
+            if future.done() and future.exception() is not None
+        ]
+
+    @property
+    def load_times(self):
+        for future in self._warm_up_futures:
+            if future.done() and future.exception() is None:
+                return future.result()
+        return {}
+
+    def pending_count(self):
+        return sum(1 for job in self.jobs.values() if not job.done)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def submit(self, query, num_dancers, duration, output_format="matrix", profile=None):
+        """
+        Queue a job and start it in the background.
+
+        Args:
+            profile (str or None): Name of a registered profiler to run the job under.
+                Profiled jobs always run in a single worker process, without chunking.
+
+        Returns:
+            Job: The new job.
+
+        Raises:
+            JobQueueFull: If running plus queued jobs already fill the pool and queue.
+            ValueError: If profile names no registered profiler.
+        """
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profile!r}; expected one of {sorted(PROFILERS)}.")
+        if self.pending_count() >= self.num_workers + self.max_queued:
+            JOBS_REJECTED.inc()
+            raise JobQueueFull()
+        JOBS_SUBMITTED.inc()
+        job = Job(query, num_dancers, duration, output_format, profile)
+        self.jobs[job.id] = job
+        self._prune_finished()
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def wait(self, job):
+        while not job.done:
+            await job.wait_for_change()
+        return job
+
+    async def iter_updates(self, job, keepalive=15):
+        """
+        Yield the job's state on every change until it finishes.
+
+        Yields None every keepalive seconds without a change.
+        """
+        version = None
+        while True:
+            if job.version != version:
+                version = job.version
+                yield job.to_dict()
+                continue
+            if job.done:
+                return
+            try:
+                await job.wait_for_change(timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+    async def iter_positions(self, job):
+        """
+        Yield the job's position entries in order as they are computed, until the job finishes.
+        """
+        index = 0
+        while True:
+            while index < len(job.positions):
+                yield job.positions[index]
+                index += 1
+            if job.done:
+                return
+            await job.wait_for_change()
+
+    async def _run(self, job):
+        phase_start = time.perf_counter()
+        executor = self.executor
+        try:
+            job.update(status="downloading")
+            video_path, video_id = await self.prepare_video(job.query, job.duration)
+            if not video_path or not os.path.exists(video_path):
+                raise RuntimeError("Video could not be downloaded.")
+            JOB_PHASE_SECONDS.observe(time.perf_counter() - phase_start, phase="download")
+            phase_start = time.perf_counter()
+            job.update(status="processing", video_path=video_path)
+            # Whole videos and long clips are split into chunks that run on several workers
+            # at once. The choice depends on the request only, never on whether the video
+            # came from the cache, so repeated requests produce the same identities.
+            # Profiled jobs always run in a single worker.
+            chunked = is_chunked(job.duration) and not job.profile
+            # A fresh download is processed while it arrives, unless it is chunked:
+            # planning chunks needs the full file
+            streaming = is_partial(video_path)
+            if streaming and chunked:
+                await self._wait_downloaded(video_path)
+                streaming = False
+            result = None
+            result_key = None
+            # Results are keyed on the video ID, so they can be looked up while the video
+            # streams in; without an ID the key is the file's contents, which needs the
+            # complete file. Profiled jobs always run the pipeline.
+            if self.cache is not None and (video_id or not streaming) and not job.profile:
+                result_key = await asyncio.to_thread(self._result_key, job, video_path, video_id)
+                result = await asyncio.to_thread(self.cache.lookup_result, result_key)
+            cached = result is not None
+            if not cached:
+                if chunked:
+                    plan = await asyncio.to_thread(plan_video_chunks, video_path)
+                else:
+                    plan = [(0.0, None)]
+                if len(plan) > 1:
+                    result = await asyncio.to_thread(self._process_chunked, job, video_path, plan)
+                else:
+                    output = await self._loop.run_in_executor(
+                        self.executor,
+                        _process_job,
+                        job.id,
+                        video_path,
+                        job.num_dancers,
+                        job.duration,
+                        GRID_SIZE,
+                        FRAME_INTERVAL,
+                        job.output_format,
+                        self._progress_queue,
+                        job.profile,
+                    )
+                    STAGE_SECONDS.merge(output["stage_seconds"])
+                    result = output["positions"]
+                    job.profile_report = output["profile"]
+                # A download that broke off ends the stream early, which would look like a short video
+                if streaming:
+                    await self._wait_downloaded(video_path)
+                JOB_PHASE_SECONDS.observe(time.perf_counter() - phase_start, phase="processing")
+                # An empty timeline means nothing could be decoded; never pin it in the cache
+                if self.cache is not None and result:
+                    try:
+                        if result_key is None:
+                            result_key = await asyncio.to_thread(self._result_key, job, video_path, video_id)
+                        await asyncio.to_thread(self.cache.store_result, result_key, result)
+                    except OSError as e:
+                        logging.warning(f"Could not cache result of job {job.id}: {e}")
+            job.update(
+                status="completed",
+                progress=1.0,
+                result=result,
+                positions=result,
+                cached=cached,
+                finished_at=time.time(),
+            )
+            JOBS_FINISHED.inc(status="completed", cached=str(cached).lower())
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            if isinstance(e, BrokenProcessPool):
+                self._restart_executor(executor)
+            job.update(status="failed", error=str(e) or type(e).__name__, finished_at=time.time())
+            JOBS_FINISHED.inc(status="failed", cached="false")
+            # Clean up the downloaded (trimmed) video
+            if job.video_path:
+                remove_media(job.video_path)
+
+    @staticmethod
+    async def _wait_downloaded(video_path):
+        """
+        Wait for a streamed download to finish.
+
+        Raises:
+            RuntimeError: If the download failed before writing the whole video.
+        """
+        if not await asyncio.to_thread(wait_complete, video_path):
+            raise RuntimeError("Video download failed before it finished.")
+
+    def _process_chunked(self, job, video_path, plan):
+        """
+        Runs on a helper thread: fans a long video's chunks out over the worker
+        pool and forwards stitched entries to the event loop as they are ready.
+        """
+
+        def report(done_chunks, total_chunks):
+            self._loop.call_soon_threadsafe(self._handle_message, job.id, "progress", done_chunks / total_chunks)
+
+        output_data = []
+        entries = iter_chunked_positions(
+            video_path,
+            job.num_dancers,
+            grid_size=GRID_SIZE,
+            frame_interval=FRAME_INTERVAL,
+            output_format=job.output_format,
+            executor=self.executor,
+            progress_callback=report,
+            stage_callback=STAGE_SECONDS.merge,
+            plan=plan,
+        )
+        for entry in entries:
+            output_data.append(entry)
+            self._loop.call_soon_threadsafe(self._handle_message, job.id, "position", entry)
+        return output_data
+
+    def _result_key(self, job, video_path, video_id=None):
+        model_versions = {
+            **registry.model_versions(),
+            **pipeline_settings(),
+            **chunk_settings(),
+            "ingest_max_height": INGEST_MAX_HEIGHT,
+        }
+        if video_id:
+            # Stable across containers: the cached remux has other bytes but the same frames
+            video_source = FormationCache.video_key(video_id, job.duration)
+        else:
+            video_source = file_digest(video_path)
+        return FormationCache.result_key(
+            video_source, job.num_dancers, GRID_SIZE, FRAME_INTERVAL, model_versions, job.output_format
+        )
+
+    def _listen_progress(self):
+        while True:
+            try:
+                message = self._progress_queue.get()
+            except (EOFError, OSError):
+                break
+            if message is None:
+                break
+            self._loop.call_soon_threadsafe(self._handle_message, *message)
+
+    def _handle_message(self, job_id, kind, payload):
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return
+        if kind == "progress":
+            job.update(progress=payload)
+        elif kind == "position":
+            job.positions.append(payload)
+            job.update()
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
@@ -1,51 +1,308 @@
 import cv2
+import functools
+import itertools
 import numpy as np
 import torch
-from ultralytics import YOLO
 import os
-from deep_sort_realtime.deepsort_tracker import DeepSort
 import logging
+import threading
 from scipy.ndimage import gaussian_filter
+from scipy.optimize import linear_sum_assignment
+from pipeline import PipelineEngine, PipelineStats
+from decoding import DECODE_MAX_WIDTH, open_video
+from models import configure_threads, registry
+from sampling import MotionSampler, keyframe_step
+from timeline import UNSEEN_DEPTH
+from tracking import DancerState, StaleQueue, TrackHistory
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize models and devices
-yolo_model = YOLO("yolov8n.pt")
-midas = torch.hub.load("intel-isl/MiDaS", "MiDaS_small").eval()
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-midas.to(device)
-midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-transform = midas_transforms.small_transform
-tracker = DeepSort(max_age=30, n_init=3, nn_budget=100)
-
-
-def estimate_depth(frame):
-    img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    input_tensor = transform(img).to(device)
-    with torch.no_grad():
-        prediction = midas(input_tensor)
+# Thread pools for batched CPU inference (KADA_INTRA_OP_THREADS / KADA_INTER_OP_THREADS)
+configure_threads()
+
+# Bump whenever a change alters the position matrices produced for the same
+# inputs, so cached results from older versions are not served
+PIPELINE_VERSION = 5
+
+# "matrix" emits a grid_size x grid_size matrix per entry; "coordinates" emits
+# per-dancer sub-cell [x, y, depth] rows to be packed into a PositionTimeline
+OUTPUT_FORMATS = ("matrix", "coordinates")
+
+# COCO class index of "person", the only class requested from YOLO
+PERSON_CLASS = 0
+# YOLO confidence and NMS IoU thresholds, and inference size (longest side in pixels)
+DETECTION_CONFIDENCE = float(os.environ.get("KADA_DETECTION_CONFIDENCE", "0.25"))
+DETECTION_IOU = float(os.environ.get("KADA_DETECTION_IOU", "0.7"))
+DETECTION_IMGSZ = int(os.environ.get("KADA_DETECTION_IMGSZ", "640"))
+# Seconds at the start of a clip used to learn the stage ROI; 0 disables cropping
+ROI_SECONDS = float(os.environ.get("KADA_ROI_SECONDS", "0"))
+# Fraction of the learned ROI's size added on each side
+ROI_MARGIN = 0.15
+
+# Run detection and depth only on motion-selected keyframes
+ADAPTIVE_SAMPLING = os.environ.get("KADA_ADAPTIVE_SAMPLING", "0") == "1"
+# Default wall-clock budget in seconds for processing one video (one chunk of a chunked
+# job); enables adaptive sampling and drops keyframes to finish within it. Unset disables it.
+TIME_BUDGET = float(os.environ["KADA_TIME_BUDGET"]) if os.environ.get("KADA_TIME_BUDGET") else None
+
+# Number of sampled frames sent through YOLO and MiDaS together
+DEFAULT_BATCH_SIZE = int(os.environ.get("KADA_BATCH_SIZE", "1"))
+# Inference threads for the pipelined engine; 0 keeps the serial loop
+DEFAULT_INFERENCE_WORKERS = int(os.environ.get("KADA_INFERENCE_WORKERS", "0"))
+# Per-frame details are logged at DEBUG; INFO gets a progress line every this many frames (0 disables it)
+LOG_EVERY_FRAMES = int(os.environ.get("KADA_LOG_EVERY_FRAMES", "300"))
+
+def pipeline_settings():
+    """
+    Settings that change the produced positions, for keying cached results.
+    """
+    return {
+        "pipeline": PIPELINE_VERSION,
+        "detection_confidence": DETECTION_CONFIDENCE,
+        "detection_iou": DETECTION_IOU,
+        "detection_imgsz": DETECTION_IMGSZ,
+        "roi_seconds": ROI_SECONDS,
+        "adaptive_sampling": ADAPTIVE_SAMPLING,
+        "time_budget": TIME_BUDGET,
+        "decode_max_width": DECODE_MAX_WIDTH,
+    }
+
+
+# Longest side of the depth map kept per frame. MiDaS_small predicts at 256px,
+# so upsampling to full frame resolution only adds interpolation and filter cost.
+DEPTH_MAP_MAX_SIDE = 384
+# Maximum grid distance for handing a dancer number to a different track
+REATTACH_DISTANCE = 3
+
+
+class DepthMap:
+    """
+    Normalized depth map for one frame with O(1) bounding box averages.
+
+    The map may be stored at a reduced resolution; bounding boxes are given in
+    frame pixel coordinates and scaled onto the map. A summed-area table is
+    built once so every tracked dancer can look up its depth without rescanning
+    the map.
+    """
+
+    def __init__(self, depth_map, scale_x=1.0, scale_y=1.0):
+        self.depth_map = depth_map
+        self.scale_x = scale_x
+        self.scale_y = scale_y
+        self.height, self.width = depth_map.shape
+        # Leading row/column of zeros so box sums need no edge cases
+        self.integral = np.zeros((self.height + 1, self.width + 1), dtype=np.float64)
+        np.cumsum(np.cumsum(depth_map, axis=0, dtype=np.float64), axis=1, out=self.integral[1:, 1:])
+
+    def average(self, bbox):
+        """
+        Average depth inside a bounding box.
+
+        Args:
+            bbox (list): [x1, y1, x2, y2] in frame pixel coordinates.
+
+        Returns:
+            float: Mean normalized depth of the box, clipped to the map.
+        """
+        x1 = min(max(int(bbox[0] * self.scale_x), 0), self.width - 1)
+        y1 = min(max(int(bbox[1] * self.scale_y), 0), self.height - 1)
+        x2 = min(max(int(np.ceil(bbox[2] * self.scale_x)), x1 + 1), self.width)
+        y2 = min(max(int(np.ceil(bbox[3] * self.scale_y)), y1 + 1), self.height)
+        integral = self.integral
+        total = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+        return float(total / ((x2 - x1) * (y2 - y1)))
+
+
+def estimate_depth(frame, max_side=DEPTH_MAP_MAX_SIDE):
+    """
+    Run MiDaS once on a frame and return a shared DepthMap.
+
+    Args:
+        frame (np.ndarray): BGR frame.
+        max_side (int or None): Longest side of the returned map; None keeps full resolution.
+
+    Returns:
+        DepthMap: Normalized depth map with a summed-area table for lookups.
+    """
+    return estimate_depth_batch([frame], max_side=max_side)[0]
+
+
+def estimate_depth_batch(frames, max_side=DEPTH_MAP_MAX_SIDE):
+    """
+    Run MiDaS on a batch of same-sized frames in a single forward pass.
+
+    Args:
+        frames (list): BGR frames, all with the same shape.
+        max_side (int or None): Longest side of the returned maps; None keeps full resolution.
+
+    Returns:
+        list: One DepthMap per frame, in input order.
+    """
+    if not frames:
+        return []
+    imgs = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
+    frame_height, frame_width = imgs[0].shape[:2]
+    scale = min(1.0, max_side / max(frame_height, frame_width)) if max_side else 1.0
+    map_height = max(1, int(round(frame_height * scale)))
+    map_width = max(1, int(round(frame_width * scale)))
+    transform = registry.midas_transform
+    input_tensor = torch.cat([transform(img) for img in imgs]).to(registry.device)
+    with torch.inference_mode():
+        prediction = registry.midas(input_tensor)
         prediction = torch.nn.functional.interpolate(
             prediction.unsqueeze(1),
-            size=img.shape[:2],
+            size=(map_height, map_width),
             mode="bicubic",
             align_corners=False,
-        ).squeeze()
-    depth_map = prediction.cpu().numpy()
-    depth_map = gaussian_filter(depth_map, sigma=2)  # Apply Gaussian filter for smoothing
-    depth_min, depth_max = depth_map.min(), depth_map.max()
-    depth_map_normalized = (
-        (depth_map - depth_min) / (depth_max - depth_min)
-        if depth_max > depth_min
-        else np.zeros_like(depth_map)
-    )
-    return depth_map_normalized
+        ).squeeze(1)
+    depth_maps = []
+    for depth_map in prediction.cpu().numpy():
+        depth_map = gaussian_filter(depth_map, sigma=2 * scale)  # Apply Gaussian filter for smoothing
+        depth_min, depth_max = depth_map.min(), depth_map.max()
+        depth_map_normalized = (
+            (depth_map - depth_min) / (depth_max - depth_min)
+            if depth_max > depth_min
+            else np.zeros_like(depth_map)
+        )
+        depth_maps.append(DepthMap(depth_map_normalized, map_width / frame_width, map_height / frame_height))
+    return depth_maps
+
+
+class PersonDetector:
+    """
+    YOLO person detection with configurable thresholds and an optional stage ROI.
+
+    Only the COCO person class is requested from the model, and boxes and
+    confidences are moved off the device in one transfer per frame. When
+    ``roi_warmup_frames`` is set, the union of all person boxes seen in the
+    first frames (grown by ``roi_margin``) becomes a crop applied to every
+    later frame, so the detector runs on a smaller, better-targeted input.
+    Boxes are always returned in full-frame coordinates.
+    """
 
+    def __init__(
+        self,
+        confidence=DETECTION_CONFIDENCE,
+        iou=DETECTION_IOU,
+        imgsz=DETECTION_IMGSZ,
+        roi_warmup_frames=0,
+        roi_margin=ROI_MARGIN,
+    ):
+        self.confidence = confidence
+        self.iou = iou
+        self.imgsz = imgsz
+        self.roi_warmup_frames = roi_warmup_frames
+        self.roi_margin = roi_margin
+        self.roi = None  # (x1, y1, x2, y2) crop in frame pixels once learned
+        self._roi_union = None
+        self._frames_seen = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, frames):
+        """
+        Args:
+            frames (list): BGR frames of the same size.
+
+        Returns:
+            list: Per frame, a list of Deep SORT detections ([x, y, w, h], confidence, "person").
+        """
+        if not frames:
+            return []
+        roi = self.roi
+        offset_x, offset_y = 0, 0
+        if roi is not None:
+            offset_x, offset_y, x2, y2 = roi
+            frames = [np.ascontiguousarray(frame[offset_y:y2, offset_x:x2]) for frame in frames]
+        with registry.borrow_yolo() as yolo:
+            results = yolo(
+                frames,
+                classes=[PERSON_CLASS],
+                conf=self.confidence,
+                iou=self.iou,
+                imgsz=self.imgsz,
+                verbose=False,
+            )
+        batch_detections = []
+        batch_boxes = []
+        for result in results:
+            boxes = result.boxes
+            xyxy = boxes.xyxy.cpu().numpy().astype(int) + [offset_x, offset_y, offset_x, offset_y]
+            confidences = boxes.conf.cpu().numpy()
+            batch_boxes.append(xyxy)
+            batch_detections.append(
+                [
+                    ([x1, y1, x2 - x1, y2 - y1], float(confidence), "person")
+                    for (x1, y1, x2, y2), confidence in zip(xyxy.tolist(), confidences)
+                ]
+            )
+        if roi is None and self.roi_warmup_frames:
+            self._learn_roi(batch_boxes, frames[0].shape)
+        return batch_detections
+
+    def _learn_roi(self, batch_boxes, frame_shape):
+        with self._lock:
+            if self.roi is not None:
+                return
+            for xyxy in batch_boxes:
+                if len(xyxy):
+                    union = np.concatenate([xyxy[:, :2].min(axis=0), xyxy[:, 2:].max(axis=0)])
+                    if self._roi_union is not None:
+                        union = np.concatenate(
+                            [np.minimum(union[:2], self._roi_union[:2]), np.maximum(union[2:], self._roi_union[2:])]
+                        )
+                    self._roi_union = union
+            self._frames_seen += len(batch_boxes)
+            if self._frames_seen < self.roi_warmup_frames or self._roi_union is None:
+                return
+            frame_height, frame_width = frame_shape[:2]
+            x1, y1, x2, y2 = self._roi_union
+            pad_x = int((x2 - x1) * self.roi_margin)
+            pad_y = int((y2 - y1) * self.roi_margin)
+            self.roi = (
+                max(0, int(x1) - pad_x),
+                max(0, int(y1) - pad_y),
+                min(frame_width, int(x2) + pad_x),
+                min(frame_height, int(y2) + pad_y),
+            )
+            logging.info(f"Learned stage ROI {self.roi} from the first {self._frames_seen} sampled frames.")
+
+
+def compute_embeddings(frame, detections):
+    """
+    Appearance embeddings for Deep SORT from the shared embedder.
+
+    Args:
+        frame (np.ndarray): BGR frame.
+        detections (list): Deep SORT detections ([x, y, w, h], confidence, label).
+
+    Returns:
+        list: One embedding per detection.
+    """
+    if not detections:
+        return []
+    frame_height, frame_width = frame.shape[:2]
+    crops = []
+    for (x, y, w, h), _, _ in detections:
+        x1 = min(max(int(x), 0), frame_width - 1)
+        y1 = min(max(int(y), 0), frame_height - 1)
+        x2 = min(max(int(x + w), x1 + 1), frame_width)
+        y2 = min(max(int(y + h), y1 + 1), frame_height)
+        crops.append(frame[y1:y2, x1:x2])
+    return registry.embedder.predict(crops)
 
 
 def calculate_average_depth(depth_map, bbox):
-    x1, y1, x2, y2 = bbox
-    return np.mean(depth_map[y1:y2, x1:x2])
+    return depth_map.average(bbox)
+
+
+def normalized_center(bbox, frame_width, frame_height):
+    """
+    Bounding box center as sub-cell (x, y) floats in [0, 1] across the frame.
+    """
+    x_center = (bbox[0] + bbox[2]) / 2 / frame_width
+    y_center = (bbox[1] + bbox[3]) / 2 / frame_height
+    return (float(np.clip(x_center, 0.0, 1.0)), float(np.clip(y_center, 0.0, 1.0)))
 
 
 def normalize_position(bbox, frame_width, frame_height, grid_size=15, margin=0.05):
@@ -53,8 +310,7 @@ def normalize_position(bbox, frame_width, frame_height, grid_size=15, margin=0.0
     Normalize the bounding box center to grid coordinates with optional margins.
     Improved to handle non-uniform scaling better.
     """
-    x_center = (bbox[0] + bbox[2]) / 2 / frame_width
-    y_center = (bbox[1] + bbox[3]) / 2 / frame_height
+    x_center, y_center = normalized_center(bbox, frame_width, frame_height)
 
     # Apply margins
     x_center = np.clip(x_center, margin, 1 - margin)
@@ -65,48 +321,99 @@ def normalize_position(bbox, frame_width, frame_height, grid_size=15, margin=0.0
 
     return (grid_x, grid_y)
 
+@functools.lru_cache(maxsize=None)
+def ring_offsets(grid_size):
+    """
+    Precomputed search order for the nearest free cell around an occupied one.
+
+    Offsets are grouped by Chebyshev ring (radius 1 up to grid_size - 1) and, within
+    a ring, ordered by dx then dy, which is the order the original spiral search
+    visited them in.
+
+    Returns:
+        tuple: (dx, dy) integer arrays of equal length.
+    """
+    radius = np.arange(-(grid_size - 1), grid_size)
+    dx, dy = np.meshgrid(radius, radius, indexing="ij")
+    dx, dy = dx.ravel(), dy.ravel()
+    ring = np.maximum(np.abs(dx), np.abs(dy))
+    order = np.lexsort((dy, dx, ring))
+    order = order[ring[order] > 0]
+    return dx[order], dy[order]
+
+
 def generate_position_matrix(dancer_states, grid_size=15):
     """
     Generate a position matrix ensuring dancers are spread out on the grid.
+
+    Dancers are placed in descending depth order; a dancer whose cell is taken moves
+    to the nearest free cell using the precomputed ring_offsets table.
+
+    Returns:
+        np.ndarray: (grid_size, grid_size) uint16 matrix of dancer numbers, 0 for empty cells.
     """
-    position_matrix = [[0 for _ in range(grid_size)] for _ in range(grid_size)]
-    sorted_dancers = sorted(dancer_states.items(), key=lambda item: item[1]["depth"], reverse=True)
+    position_matrix = np.zeros((grid_size, grid_size), dtype=np.uint16)
+    sorted_dancers = sorted(dancer_states.items(), key=lambda item: item[1].depth, reverse=True)
 
     for dancer_num, state in sorted_dancers:
-        x, y = state["grid_position"]
-        if position_matrix[y][x] == 0:
-            position_matrix[y][x] = dancer_num
+        x, y = state.grid_position
+        if position_matrix[y, x] == 0:
+            position_matrix[y, x] = dancer_num
+            continue
+        dx, dy = ring_offsets(grid_size)
+        nx, ny = x + dx, y + dy
+        in_bounds = (nx >= 0) & (nx < grid_size) & (ny >= 0) & (ny < grid_size)
+        nx, ny = nx[in_bounds], ny[in_bounds]
+        free = np.flatnonzero(position_matrix[ny, nx] == 0)
+        if free.size:
+            position_matrix[ny[free[0]], nx[free[0]]] = dancer_num
         else:
-            # Find the nearest unoccupied cell using a spiral search
-            found = False
-            for radius in range(1, grid_size):
-                for dx in range(-radius, radius + 1):
-                    for dy in range(-radius, radius + 1):
-                        nx, ny = x + dx, y + dy
-                        if 0 <= nx < grid_size and 0 <= ny < grid_size and position_matrix[ny][nx] == 0:
-                            position_matrix[ny][nx] = dancer_num
-                            found = True
-                            break
-                    if found:
-                        break
-                if found:
-                    break
-            if not found:
-                logging.warning(f"No available position found for dancer {dancer_num}")
+            logging.warning(f"No available position found for dancer {dancer_num}")
     return position_matrix
 
 
+def gated_assignment(costs, threshold):
+    """
+    Minimum-cost one-to-one matching that never pairs rows and columns costing more than threshold.
+
+    Args:
+        costs (np.ndarray): (rows, cols) cost matrix; inf or NaN marks impossible pairs.
+        threshold (float): Largest admissible cost.
+
+    Returns:
+        list: (row, col) index pairs.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if costs.size == 0:
+        return []
+    gated = ~(costs <= threshold)
+    # Gated pairs get a cost no admissible matching can prefer
+    padded = np.where(gated, threshold * sum(costs.shape) + 1, costs)
+    rows, cols = linear_sum_assignment(padded)
+    return [(row, col) for row, col in zip(rows, cols) if not gated[row, col]]
+
+
 class DanceFormationGenerator:
-    def __init__(self, num_dancers, grid_size=15, distance_threshold=3):
+    def __init__(self, num_dancers, grid_size=15, distance_threshold=REATTACH_DISTANCE, roi_seconds=ROI_SECONDS):
         self.num_dancers = num_dancers
         self.grid_size = grid_size
         self.distance_threshold = distance_threshold  # Maximum grid distance to consider for reattachment
         self.current_dancer_num = 1
         self.track_id_to_dancer_num = {}
         self.dancer_num_to_track_id = {}
-        self.dancer_states = {}
+        self.dancer_states = {}  # Dancer number -> DancerState
         self.default_positions = self.define_default_positions(num_dancers, grid_size)
-        self.track_history = {}  # New: Keeps a history of track IDs to dancer numbers
+        self.track_history = TrackHistory()  # Recent track IDs -> dancer numbers, LRU-bounded
+        self.stale_queue = StaleQueue()  # Dancers ordered by last update, for stale expiry
+        self.roi_seconds = roi_seconds  # Seconds used to learn the stage ROI, 0 disables it
+        self.detector = PersonDetector()
+        self.tracker = registry.new_tracker()  # Tracker state is scoped to this generator
+        self.stats = PipelineStats()  # Per-stage timings of the current run
+        self.stage_hooks = []  # Extra listener(stage, elapsed) callables attached to every run's stats
+        self.pipeline_stats = None  # Per-stage timing and queue depth of the last run
+        self._max_dancers_warned = False
+        self.sampler = None  # MotionSampler of the current run, if adaptive
+        self._predicted_tracks = {}  # Track ID -> Kalman (mean, covariance) extrapolated past the last keyframe
         logging.info(f"DanceFormationGenerator initialized with {num_dancers} dancers and grid size {grid_size}.")
 
     def define_default_positions(self, num_dancers, grid_size=15):
@@ -140,30 +447,9 @@ class DanceFormationGenerator:
                 dancer_num += 1
         return default_positions
 
-    def find_closest_dancer(self, grid_position):
-        """
-        Find the closest dancer based on grid position.
-        
-        Args:
-            grid_position (tuple): (grid_x, grid_y) of the new detection.
-        
-        Returns:
-            int or None: Dancer number if a close dancer is found; otherwise, None.
-        """
-        min_distance = float('inf')
-        closest_dancer = None
-        for dancer_num, state in self.dancer_states.items():
-            last_position = state.get("grid_position")
-            if last_position:
-                distance = np.linalg.norm(np.array(grid_position) - np.array(last_position))
-                if distance < min_distance and distance <= self.distance_threshold:
-                    min_distance = distance
-                    closest_dancer = dancer_num
-        return closest_dancer
-
     def assign_dancer_num(self, track_id, grid_position):
         """
-        Assign a dancer number to a given track ID. Reattach identity based on proximity and history.
+        Assign a dancer number to a single track ID. See assign_dancer_nums.
         
         Args:
             track_id (int): The track ID from Deep SORT.
@@ -172,175 +458,435 @@ class DanceFormationGenerator:
         Returns:
             int or None: Assigned dancer number or None if no assignment is possible.
         """
-        # If track ID has been seen before, use its existing mapping
-        if track_id in self.track_id_to_dancer_num:
-            return self.track_id_to_dancer_num[track_id]
-        
-        # Check history for recently seen track IDs and their positions
-        for old_track_id, old_dancer_num in self.track_history.items():
-            if old_track_id not in self.track_id_to_dancer_num:
-                # Check if this history aligns with the current grid position
-                old_position = self.dancer_states.get(old_dancer_num, {}).get("grid_position")
-                if old_position and np.linalg.norm(np.array(grid_position) - np.array(old_position)) <= self.distance_threshold:
-                    # Reattach identity
-                    self.track_id_to_dancer_num[track_id] = old_dancer_num
-                    self.dancer_num_to_track_id[old_dancer_num] = track_id
-                    logging.info(f"Reattached historical dancer number {old_dancer_num} to track ID {track_id}.")
-                    return old_dancer_num
+        return self.assign_dancer_nums([(track_id, grid_position)]).get(track_id)
+
+    def assign_dancer_nums(self, track_positions):
+        """
+        Assign dancer numbers to all confirmed tracks of a frame at once.
+
+        Tracks with an existing mapping keep it. A track whose mapping was dropped
+        as stale but which DeepSort kept alive gets its dancer number back from
+        track_history, if no other track has taken it. The remaining tracks are
+        matched against every dancer not already claimed this frame with a single
+        Hungarian assignment on grid distance, gated by distance_threshold, so the
+        order tracks arrive in cannot let one track steal another's identity.
+        Tracks left unmatched get new dancer numbers while under the limit.
         
-        # Attempt to find the closest existing dancer
-        closest_dancer = self.find_closest_dancer(grid_position)
-        if closest_dancer is not None:
-            # Reattach identity
-            self.track_id_to_dancer_num[track_id] = closest_dancer
-            self.dancer_num_to_track_id[closest_dancer] = track_id
-            logging.info(f"Reattached dancer number {closest_dancer} to track ID {track_id}.")
-            return closest_dancer
+        Args:
+            track_positions (list): (track_id, (grid_x, grid_y)) for each confirmed track.
         
-        # Assign a new dancer number only if under the limit
-        if self.current_dancer_num <= self.num_dancers:
+        Returns:
+            dict: Mapping from track ID to assigned dancer number; tracks that could
+            not be assigned are omitted.
+        """
+        assignments = {}
+        unmatched = []
+        for track_id, grid_position in track_positions:
+            # If track ID has been seen before, use its existing mapping
+            if track_id in self.track_id_to_dancer_num:
+                assignments[track_id] = self.track_id_to_dancer_num[track_id]
+            else:
+                unmatched.append((track_id, grid_position))
+        if not unmatched:
+            return assignments
+
+        still_unmatched = []
+        for track_id, grid_position in unmatched:
+            dancer_num = self.track_history.get(track_id)
+            if dancer_num is None or dancer_num in self.dancer_num_to_track_id:
+                still_unmatched.append((track_id, grid_position))
+                continue
+            self.track_id_to_dancer_num[track_id] = dancer_num
+            self.dancer_num_to_track_id[dancer_num] = track_id
+            self.track_history.record(track_id, dancer_num)
+            assignments[track_id] = dancer_num
+            logging.debug(f"Restored dancer number {dancer_num} to returning track ID {track_id}.")
+        unmatched = still_unmatched
+        if not unmatched:
+            return assignments
+
+        claimed = set(assignments.values())
+        candidates = [
+            (dancer_num, state.grid_position)
+            for dancer_num, state in self.dancer_states.items()
+            if dancer_num not in claimed and state.grid_position is not None
+        ]
+        if candidates:
+            track_grid = np.array([position for _, position in unmatched], dtype=np.float64)
+            dancer_grid = np.array([position for _, position in candidates], dtype=np.float64)
+            distances = np.linalg.norm(track_grid[:, None, :] - dancer_grid[None, :, :], axis=2)
+            matched_rows = set()
+            for row, col in gated_assignment(distances, self.distance_threshold):
+                track_id = unmatched[row][0]
+                dancer_num = candidates[col][0]
+                # Reattach identity, dropping the dancer's previous track mapping
+                previous_track_id = self.dancer_num_to_track_id.get(dancer_num)
+                if previous_track_id is not None:
+                    self.track_id_to_dancer_num.pop(previous_track_id, None)
+                self.track_id_to_dancer_num[track_id] = dancer_num
+                self.dancer_num_to_track_id[dancer_num] = track_id
+                self.track_history.record(track_id, dancer_num)
+                assignments[track_id] = dancer_num
+                matched_rows.add(row)
+                logging.debug(f"Reattached dancer number {dancer_num} to track ID {track_id}.")
+            unmatched = [track for row, track in enumerate(unmatched) if row not in matched_rows]
+
+        for track_id, _ in unmatched:
+            # Skip numbers already attached to a track through reattachment
+            while self.current_dancer_num in self.dancer_num_to_track_id:
+                self.current_dancer_num += 1
+            # Assign a new dancer number only if under the limit
+            if self.current_dancer_num > self.num_dancers:
+                # Extra tracks recur every frame, so this is only reported once per run
+                if not self._max_dancers_warned:
+                    self._max_dancers_warned = True
+                    logging.warning(
+                        f"Maximum number of dancers ({self.num_dancers}) reached. Cannot assign new dancer number."
+                    )
+                break
             dancer_num = self.current_dancer_num
             self.track_id_to_dancer_num[track_id] = dancer_num
             self.dancer_num_to_track_id[dancer_num] = track_id
+            self.track_history.record(track_id, dancer_num)
             self.current_dancer_num += 1
-            logging.info(f"Assigned dancer number {dancer_num} to new track ID {track_id}.")
-            return dancer_num
-        
-        logging.warning(f"Maximum number of dancers ({self.num_dancers}) reached. Cannot assign new dancer number.")
-        return None
+            assignments[track_id] = dancer_num
+            logging.debug(f"Assigned dancer number {dancer_num} to new track ID {track_id}.")
+        return assignments
     
     def update_track_history(self):
         """
-        Updates the history of track IDs to retain recently used track-to-dancer mappings.
+        Record the current track-to-dancer mappings in the history.
+
+        assign_dancer_nums records every new mapping as it is made, so this is
+        only needed after changing the mappings directly.
         """
-        max_history_length = 50  # Keep a reasonable history size to avoid memory issues
-        if len(self.track_history) > max_history_length:
-            # Trim the history dictionary to maintain a max size
-            self.track_history = dict(list(self.track_history.items())[-max_history_length:])
-        
-        # Add current mappings to the history
         for track_id, dancer_num in self.track_id_to_dancer_num.items():
-            self.track_history[track_id] = dancer_num
+            self.track_history.record(track_id, dancer_num)
 
     def remove_stale_tracks(self, current_frame):
         """
         Remove track mappings that haven't been updated recently.
+
+        Only dancers whose last update left the stale window since the previous
+        call are visited, through stale_queue.
         
         Args:
             current_frame (int): The current frame count.
         """
-        stale_threshold = 60  # Number of frames to consider a track as stale
-        stale_dancers = []
-        for dancer_num, state in self.dancer_states.items():
-            last_seen = state.get("last_seen", 0)
-            if current_frame - last_seen > stale_threshold:
-                stale_dancers.append(dancer_num)
-        
-        for dancer_num in stale_dancers:
-            track_id = self.dancer_num_to_track_id.get(dancer_num)
+        for dancer_num in self.stale_queue.pop_stale(current_frame):
+            track_id = self.dancer_num_to_track_id.pop(dancer_num, None)
             if track_id is not None:
                 del self.track_id_to_dancer_num[track_id]
-                del self.dancer_num_to_track_id[dancer_num]
-                logging.info(f"Removed stale mapping for dancer number {dancer_num} (track ID {track_id}).")
-            # Optionally, reset dancer state or assign a new default position
-            # Here, we keep the last known position
-            # self.dancer_states[dancer_num] = {
-            #     "depth": float("inf"),
-            #     "grid_position": self.default_positions[dancer_num],
-            #     "last_seen": current_frame,
-            # }
-
-    def generate_position_matrices(self, video_path, frame_interval=10):
+                logging.debug(f"Removed stale mapping for dancer number {dancer_num} (track ID {track_id}).")
+            # The dancer keeps its last known position
+
+    def reset_dancer_states(self, frame_count=0):
+        """
+        Place every dancer at its default position before processing a video.
+        """
+        self.stale_queue.clear()
+        for dancer_num, position in self.default_positions.items():
+            self.dancer_states[dancer_num] = DancerState(
+                depth=float("inf"),
+                grid_position=position,
+                position=(position[0] / (self.grid_size - 1), position[1] / (self.grid_size - 1)),
+                last_seen=frame_count,
+            )
+            self.stale_queue.touch(dancer_num, frame_count)
+
+    def process_frame(self, frame, frame_count, detections, depth_map=None):
+        """
+        Run the ordered tracking/assignment stage for one sampled frame.
+
+        Args:
+            frame (np.ndarray): BGR frame the detections belong to.
+            frame_count (int): Index of the frame in the video.
+            detections (list): Deep SORT detections for the frame.
+            depth_map (DepthMap or None): Precomputed depth; estimated lazily when None.
+        """
+        logging.debug(f"Number of detections: {len(detections)}")
+        with self.stats.timer("embed"):
+            embeds = compute_embeddings(frame, detections)
+        with self.stats.timer("track"):
+            # Update tracker
+            tracks = self.tracker.update_tracks(detections, embeds=embeds, frame=frame)
+            frame_height, frame_width = frame.shape[:2]
+            confirmed = []
+            for track in tracks:
+                if not track.is_confirmed():
+                    continue
+                bbox = [int(coord) for coord in track.to_ltrb()]
+                # Normalize position first to pass to assign_dancer_nums
+                grid_position = normalize_position(bbox, frame_width, frame_height, grid_size=self.grid_size)
+                confirmed.append((track.track_id, bbox, grid_position))
+            assignments = self.assign_dancer_nums(
+                [(track_id, grid_position) for track_id, _, grid_position in confirmed]
+            )
+        for track_id, bbox, grid_position in confirmed:
+            dancer_num = assignments.get(track_id)
+            if dancer_num:
+                # Depth is estimated at most once per frame and shared by all tracks
+                if depth_map is None:
+                    with self.stats.timer("depth"):
+                        depth_map = estimate_depth(frame)
+                depth = calculate_average_depth(depth_map, bbox)
+                # Update dancer state
+                state = self.dancer_states[dancer_num]
+                state.depth = depth
+                state.grid_position = grid_position
+                state.position = normalized_center(bbox, frame_width, frame_height)
+                state.last_seen = frame_count
+                self.stale_queue.touch(dancer_num, frame_count)
+        # Non-keyframes extrapolate from this frame's track states
+        self._predicted_tracks = {}
+        if self.sampler is not None:
+            self.sampler.set_regions([bbox for _, bbox, _ in confirmed], frame.shape)
+        # Remove stale tracks
+        self.remove_stale_tracks(frame_count)
+
+    def predict_frame(self, frame, frame_count):
+        """
+        Advance dancers on a non-keyframe using the tracker's motion model only.
+
+        Confirmed tracks are moved to their Kalman-predicted boxes; identities and
+        depth are left as of the last keyframe. The prediction runs on copies of
+        each track's mean and covariance, chained across consecutive
+        non-keyframes, so the tracker itself (ages, time since update, Kalman
+        state) is unchanged and skipped frames do not weaken association on the
+        next keyframe.
+        """
+        with self.stats.timer("track"):
+            kf = self.tracker.tracker.kf
+            frame_height, frame_width = frame.shape[:2]
+            for track in self.tracker.tracker.tracks:
+                dancer_num = self.track_id_to_dancer_num.get(track.track_id)
+                if dancer_num is None or not track.is_confirmed():
+                    continue
+                mean, covariance = self._predicted_tracks.get(track.track_id, (track.mean, track.covariance))
+                mean, covariance = kf.predict(mean.copy(), covariance.copy())
+                self._predicted_tracks[track.track_id] = (mean, covariance)
+                # Kalman state is (center x, center y, aspect ratio, height, velocities...)
+                center_x, center_y, aspect, height = mean[:4]
+                width = aspect * height
+                bbox = [
+                    int(center_x - width / 2),
+                    int(center_y - height / 2),
+                    int(center_x + width / 2),
+                    int(center_y + height / 2),
+                ]
+                state = self.dancer_states[dancer_num]
+                state.grid_position = normalize_position(
+                    bbox, frame_width, frame_height, grid_size=self.grid_size
+                )
+                state.position = normalized_center(bbox, frame_width, frame_height)
+
+    def build_output_entry(self, timestamp, output_format="matrix"):
+        """
+        Snapshot the current dancer states as an output entry.
+
+        Args:
+            timestamp (float): Time of the frame in seconds.
+            output_format (str): "matrix" for a grid position matrix, "coordinates" for
+                per-dancer [x, y, depth] rows ordered by dancer number.
+
+        Returns:
+            dict: {"timestamp", "position_matrix"} or {"timestamp", "coordinates"}.
+        """
+        if output_format == "coordinates":
+            coordinates = []
+            for dancer_num in range(1, self.num_dancers + 1):
+                state = self.dancer_states[dancer_num]
+                depth = state.depth if np.isfinite(state.depth) else UNSEEN_DEPTH
+                coordinates.append([state.position[0], state.position[1], float(depth)])
+            return {"timestamp": timestamp, "coordinates": coordinates}
+        position_matrix = generate_position_matrix(self.dancer_states, self.grid_size)
+        return {"timestamp": timestamp, "position_matrix": position_matrix.tolist()}
+
+    def generate_position_matrices(self, video_path, *args, **kwargs):
         """
         Generate position matrices for each relevant frame in the video.
+
+        Collects iter_position_matrices, which takes the same arguments, into a list.
+
+        Returns:
+            list: List of position matrices with timestamps.
+        """
+        return list(self.iter_position_matrices(video_path, *args, **kwargs))
+
+    def iter_position_matrices(
+        self,
+        video_path,
+        frame_interval=10,
+        batch_size=None,
+        inference_workers=None,
+        progress_callback=None,
+        output_format="matrix",
+        adaptive=None,
+        time_budget=None,
+        start_time=0.0,
+        end_time=None,
+        include_states=False,
+    ):
+        """
+        Yield position matrices for each relevant frame in the video as soon as they are computed.
         
         Args:
             video_path (str): Path to the input video.
             frame_interval (int): Number of frames to skip between processing.
+            batch_size (int or None): Sampled frames per YOLO/MiDaS batch; defaults to DEFAULT_BATCH_SIZE.
+            inference_workers (int or None): Inference threads for the pipelined engine;
+                defaults to DEFAULT_INFERENCE_WORKERS, 0 runs decode/inference/tracking serially.
+            progress_callback (callable or None): Called as progress_callback(frame_count, total_frames)
+                after each processed frame.
+            output_format (str): One of OUTPUT_FORMATS, see build_output_entry.
+            adaptive (bool or None): Sample twice per frame_interval and run detection and depth
+                only on keyframes picked by a MotionSampler, predicting positions with the tracker
+                in between; defaults to ADAPTIVE_SAMPLING.
+            time_budget (float or None): Seconds allowed for the whole clip; enables adaptive
+                sampling and lets the sampler drop keyframes to stay within it. Defaults to
+                TIME_BUDGET.
+            start_time (float): Seconds into the video to start from (seeks to the preceding keyframe).
+            end_time (float or None): Seconds into the video to stop before; None runs to the end.
+            include_states (bool): Add a "dancers" mapping of every dancer seen so far to its
+                [grid_x, grid_y, depth], used to stitch chunks together.
             
+        Yields:
+            dict: {"timestamp": float, "position_matrix": list} (or "coordinates") in timestamp order.
+
+        Raises:
+            IOError: If the video cannot be opened.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}; expected one of {OUTPUT_FORMATS}.")
+        batch_size = max(1, batch_size or DEFAULT_BATCH_SIZE)
+        if inference_workers is None:
+            inference_workers = DEFAULT_INFERENCE_WORKERS
+        # A video that cannot be opened fails the run instead of yielding an empty timeline
+        decoder = open_video(video_path)
+        frame_rate = decoder.fps
+        total_frames = decoder.total_frames
+        self.reset_dancer_states()
+        if adaptive is None:
+            adaptive = ADAPTIVE_SAMPLING
+        if time_budget is None:
+            time_budget = TIME_BUDGET
+        if adaptive or time_budget is not None:
+            step = keyframe_step(frame_interval)
+            total_samples = max(int(((end_time or decoder.duration) - start_time) * frame_rate) // step, 0)
+            sampler = MotionSampler(time_budget=time_budget, total_samples=total_samples)
+        else:
+            step = frame_interval
+            sampler = None
+        roi_warmup_frames = int(np.ceil(self.roi_seconds * frame_rate / step)) if self.roi_seconds else 0
+        self.detector = PersonDetector(roi_warmup_frames=roi_warmup_frames)
+        self.stats = PipelineStats(listeners=self.stage_hooks)
+        self._max_dancers_warned = False
+        self.sampler = sampler
+        self._predicted_tracks = {}
+        sampled_frames = iter_sampled_frames(decoder, step, sampler, start_time, end_time)
+        if inference_workers > 0:
+            engine = PipelineEngine(
+                sampled_frames,
+                self.infer_batch,
+                batch_size=batch_size,
+                num_workers=inference_workers,
+                stats=self.stats,
+            )
+            inferred_frames = engine.run()
+        else:
+            inferred_frames = self.iter_inferred_frames(sampled_frames, batch_size)
+        next_log_frame = 0
+        try:
+            # Tracking and assignment stay sequential, in frame order
+            for ((frame_count, frame_time, frame), _), inferred in inferred_frames:
+                if inferred is None:
+                    self.predict_frame(frame, frame_count)
+                else:
+                    self.process_frame(frame, frame_count, *inferred)
+                if progress_callback is not None:
+                    progress_callback(frame_count, total_frames)
+                if LOG_EVERY_FRAMES and frame_count >= next_log_frame:
+                    next_log_frame = frame_count + LOG_EVERY_FRAMES
+                    logging.info(
+                        f"Frame {frame_count}/{total_frames or '?'}: "
+                        f"{len(self.track_id_to_dancer_num)} of {self.num_dancers} dancers tracked."
+                    )
+                # Emit position matrices at intervals, stamped with the frame's presentation time
+                if frame_count % frame_interval == 0:
+                    with self.stats.timer("matrix"):
+                        entry = self.build_output_entry(round(frame_time, 2), output_format)
+                    if include_states:
+                        entry["dancers"] = {
+                            dancer_num: [*state.grid_position, float(state.depth)]
+                            for dancer_num, state in self.dancer_states.items()
+                            if np.isfinite(state.depth)
+                        }
+                    yield entry
+        finally:
+            # Stops the pipeline threads if the consumer stopped early
+            inferred_frames.close()
+            self.pipeline_stats = self.stats.snapshot()
+            logging.info(f"Pipeline stats: {self.pipeline_stats}")
+            if sampler is not None:
+                logging.info(f"Ran full inference on {sampler.keyframes} of {sampler.samples} sampled frames.")
+            decoder.close()
+
+    def infer_batch(self, batch, eager_depth=True):
+        """
+        Run detection and depth estimation on the keyframes of a batch of
+        (DecodedFrame, keyframe) items.
+
+        Args:
+            batch (list): Sampled frame items.
+            eager_depth (bool): Estimate depth for every keyframe now; otherwise
+                process_frame estimates it lazily.
+
         Returns:
-            list: List of position matrices with timestamps.
+            list: (detections, depth_map) per keyframe item, None for other items.
+        """
+        frames = [decoded.frame for decoded, keyframe in batch if keyframe]
+        with self.stats.timer("detect"):
+            detections = iter(self.detector(frames))
+        if eager_depth and frames:
+            with self.stats.timer("depth"):
+                depth_maps = iter(estimate_depth_batch(frames))
+        else:
+            depth_maps = iter([None] * len(frames))
+        return [(next(detections), next(depth_maps)) if keyframe else None for _, keyframe in batch]
+
+    def iter_inferred_frames(self, sampled_frames, batch_size):
+        """
+        Serially run inference on batches of sampled frames.
+
+        Yields:
+            tuple: ((DecodedFrame, keyframe), inferred) in frame order, see infer_batch.
         """
-        output_data = []
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            logging.error("Cannot open video file.")
-            return output_data
-        frame_rate = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = 0
-        for dancer_num, position in self.default_positions.items():
-            self.dancer_states[dancer_num] = {
-                "depth": float("inf"),
-                "grid_position": position,
-                "last_seen": frame_count,
-            }
         while True:
-            # Skip frames by grabbing without decoding
-            for _ in range(frame_interval - 1):
-                ret = cap.grab()
-                if not ret:
-                    break
-                frame_count += 1
-            ret, frame = cap.read()
-            if not ret:
-                break
-            frame_count += 1
-            logging.info(f"Processing frame {frame_count}")
-            # Detection with YOLOv8
-            results = yolo_model(frame)
-            bounding_boxes = []
-            confidences = []
-            for result in results:
-                for box in result.boxes:
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                    confidence = box.conf[0].cpu().numpy()
-                    bounding_boxes.append([x1, y1, x2, y2])
-                    confidences.append(confidence)
-            logging.info(f"Number of detections: {len(bounding_boxes)}")
-            # Prepare detections for Deep SORT
-            detections = []
-            for bbox, conf in zip(bounding_boxes, confidences):
-                x1, y1, x2, y2 = bbox
-                detections.append(([x1, y1, x2 - x1, y2 - y1], conf, "person"))
-            # Update tracker
-            tracks = tracker.update_tracks(detections, frame=frame)
-            dancers_detected = []
-            for track in tracks:
-                if not track.is_confirmed():
-                    continue
-                track_id = track.track_id
-                ltrb = track.to_ltrb()
-                bbox = [int(coord) for coord in ltrb]
-                # Normalize position first to pass to assign_dancer_num
-                grid_position = normalize_position(
-                    bbox, frame_width := frame.shape[1], frame_height := frame.shape[0], grid_size=self.grid_size
-                )
-                dancer_num = self.assign_dancer_num(track_id, grid_position)
-                if dancer_num:
-                    # Depth estimation
-                    depth_map = estimate_depth(frame)
-                    depth = calculate_average_depth(depth_map, bbox)
-                    dancers_detected.append({"num": dancer_num, "bbox": bbox, "grid_position": grid_position})
-                    # Update dancer state
-                    self.dancer_states[dancer_num]["depth"] = depth
-                    self.dancer_states[dancer_num]["grid_position"] = grid_position
-                    self.dancer_states[dancer_num]["last_seen"] = frame_count
-            # Remove stale tracks
-            self.remove_stale_tracks(frame_count)
-            # Generate the position matrix
-            position_matrix = generate_position_matrix(self.dancer_states, self.grid_size)
-            # Save position matrices at intervals
-            if frame_count % frame_interval == 0:
-                timestamp = round(frame_count / frame_rate, 2)
-                output_entry = {
-                    "timestamp": timestamp,
-                    "position_matrix": position_matrix,
-                }
-                output_data.append(output_entry)
-                logging.info(f"Appended position matrix at timestamp {timestamp}")
-        cap.release()
-        cv2.destroyAllWindows()
-        return output_data
+            with self.stats.timer("decode"):
+                batch = list(itertools.islice(sampled_frames, batch_size))
+            if not batch:
+                return
+            # Single frames keep depth lazy so frames without confirmed dancers skip MiDaS
+            yield from zip(batch, self.infer_batch(batch, eager_depth=batch_size > 1))
+
+
+def iter_sampled_frames(decoder, frame_interval, sampler=None, start_time=0.0, end_time=None):
+    """
+    Yield every frame_interval-th frame of an open video.
+
+    Args:
+        decoder (VideoDecoder): Open video.
+        frame_interval (int): Step between sampled frames.
+        sampler (MotionSampler or None): Picks keyframes; every frame is a keyframe when None.
+        start_time (float): Seconds into the video to start from.
+        end_time (float or None): Seconds into the video to stop before.
+
+    Yields:
+        tuple: (DecodedFrame, keyframe) with frame_count counted from 1.
+    """
+    for decoded in decoder.iter_frames(frame_interval, start_time=start_time, end_time=end_time):
+        logging.debug(f"Processing frame {decoded.frame_count}")
+        yield decoded, sampler is None or sampler.is_keyframe(decoded.frame)
 
 
 class DanceFormationAPI:
@@ -348,10 +894,28 @@ class DanceFormationAPI:
         self.generator = DanceFormationGenerator(num_dancers, grid_size)
         logging.info(f"DanceFormationAPI initialized with {num_dancers} dancers and grid size {grid_size}.")
     
-    def process_video_and_get_positions(self, video_path, duration=None):
-        output_data = self.generator.generate_position_matrices(video_path)
-        print(output_data)
-        return output_data
+    def process_video_and_get_positions(
+        self, video_path, duration=None, frame_interval=10, progress_callback=None, output_format="matrix"
+    ):
+        return list(
+            self.iter_positions(
+                video_path,
+                frame_interval=frame_interval,
+                progress_callback=progress_callback,
+                output_format=output_format,
+            )
+        )
+
+    def iter_positions(self, video_path, frame_interval=10, progress_callback=None, output_format="matrix"):
+        """
+        Yield {timestamp, position_matrix} (or coordinates) entries incrementally while the video is processed.
+        """
+        return self.generator.iter_position_matrices(
+            video_path,
+            frame_interval=frame_interval,
+            progress_callback=progress_callback,
+            output_format=output_format,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+from decoding import FAILED_SUFFIX, is_partial
+
+# Videos of jobs, served to the frontend under /videos
+MEDIA_DIR = Path(os.environ.get("KADA_MEDIA_DIR", Path(__file__).resolve().parent / "media"))
+# Job videos older than this are deleted, unless an unfinished job still uses them
+MEDIA_MAX_AGE = float(os.environ.get("KADA_MEDIA_MAX_AGE", str(6 * 3600)))
+# Seconds between cleanup sweeps of the media directory
+MEDIA_CLEANUP_INTERVAL = 600
+
+# Finished files never change (every job gets a new name), so browsers may keep them
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def new_media_path(suffix=".mp4"):
+    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+    return MEDIA_DIR / f"{uuid.uuid4()}{suffix}"
+
+
+def media_path(filename):
+    """
+    Resolve a served filename inside the media directory.
+
+    Returns:
+        Path or None: The file, or None if it does not exist.
+    """
+    # Prevent directory traversal attacks
+    path = MEDIA_DIR / os.path.basename(filename)
+    return path if path.is_file() else None
+
+
+def remove_media(path):
+    """
+    Delete a job video and the failure marker its download may have left.
+    """
+    for name in (str(path), f"{path}{FAILED_SUFFIX}"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def cleanup_media(in_use=(), max_age=MEDIA_MAX_AGE):
+    """
+    Delete job videos not modified for max_age seconds.
+
+    Files still being downloaded and the paths in in_use are kept.
+
+    Returns:
+        int: Number of files deleted.
+    """
+    keep = {Path(path).resolve() for path in in_use if path}
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in MEDIA_DIR.glob("*.mp4"):
+        if path.resolve() in keep or is_partial(path):
+            continue
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        remove_media(path)
+        removed += 1
+    if removed:
+        logging.info(f"Removed {removed} old videos from {MEDIA_DIR}")
+    return removed
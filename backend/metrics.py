@@ -0,0 +1,192 @@
+import bisect
+import math
+import threading
+
+# Latency buckets (seconds) for per-frame pipeline stages
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Latency buckets (seconds) for whole job phases
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metric:
+    """
+    Base class for metrics rendered in the Prometheus text exposition format.
+
+    Values are kept per label combination; ``labelnames`` fixes which keyword
+    labels every update must pass.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields:
+            tuple: (sample name, ((label, value), ...), value).
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Unlabelled gauges can read their value from
+    a callback at render time with ``set_function``.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, (), self._function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    """
+    Cumulative-bucket histogram.
+
+    ``snapshot`` and ``merge`` move observations between processes: a worker
+    observes into its own histogram and the server merges the snapshot.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=JOB_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def _empty(self):
+        # Per-bucket (non-cumulative) counts, then sum
+        return [0] * len(self.buckets) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = self._empty()
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, counts in snapshot.items():
+                current = self._values.get(tuple(key))
+                if current is None:
+                    current = self._values[tuple(key)] = self._empty()
+                for index, count in enumerate(counts):
+                    current[index] += count
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", _format_value(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Named collection of metrics, rendered together for a /metrics endpoint.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=JOB_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Returns:
+            str: Every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# Metrics of this process, exposed by the server at /metrics
+metrics = MetricsRegistry()
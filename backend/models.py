@@ -0,0 +1,331 @@
+import contextlib
+import importlib.metadata
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+from inference import (
+    INFERENCE_BACKENDS,
+    MIDAS_ONNX,
+    YOLO_ONNX,
+    OnnxMidas,
+    OnnxYolo,
+    export_midas,
+    export_yolo,
+    quantize,
+    quantized_name,
+)
+
+# Local directory holding model weights so workers never need the network at startup.
+# Expected layout:
+#   yolov8n.pt                  YOLOv8 nano detector weights
+#   midas_v21_small_256.pt      MiDaS_small state dict
+#   MiDaS/                      clone of https://github.com/isl-org/MiDaS (provides hubconf.py)
+#   rwightman_gen-efficientnet-pytorch_master/
+#                               clone of https://github.com/rwightman/gen-efficientnet-pytorch,
+#                               the MiDaS_small backbone code (torch hub cache layout)
+#   *.onnx, *.int8.onnx         ONNX exports of both models, written on first use by the onnx backend
+WEIGHTS_DIR = Path(os.environ.get("KADA_WEIGHTS_DIR", Path(__file__).resolve().parent / "weights"))
+
+YOLO_WEIGHTS = "yolov8n.pt"
+MIDAS_WEIGHTS = "midas_v21_small_256.pt"
+MIDAS_REPO = "MiDaS"
+GEN_EFFICIENTNET_REPO = "rwightman_gen-efficientnet-pytorch_master"
+
+# "torch" runs the eager PyTorch models; "onnx" runs YOLO and MiDaS in ONNX Runtime on the CPU
+INFERENCE_BACKEND = os.environ.get("KADA_INFERENCE_BACKEND", "torch")
+# With the onnx backend, use int8 dynamically quantized copies of the exported graphs
+ONNX_QUANTIZE = os.environ.get("KADA_ONNX_QUANTIZE", "0") == "1"
+# Threads per process within an operator and across independent operators, for
+# torch and ONNX Runtime alike; 0 keeps the library defaults. With several job
+# workers, keep workers * intra-op threads at or below the core count.
+INTRA_OP_THREADS = int(os.environ.get("KADA_INTRA_OP_THREADS", os.environ.get("KADA_TORCH_THREADS", "0")))
+INTER_OP_THREADS = int(os.environ.get("KADA_INTER_OP_THREADS", "0"))
+
+
+def configure_threads(intra_op_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS):
+    """
+    Apply the torch thread settings of this process.
+
+    Call before any inference: torch only accepts the inter-op thread count
+    while its inter-op pool has not started.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            logging.warning("Torch inter-op threads are already in use; KADA_INTER_OP_THREADS was not applied.")
+
+
+def _import_from_repo(repo, module):
+    """
+    Import a module from a local repository checkout, like torch.hub does for hubconf.py.
+    """
+    sys.path.insert(0, str(repo))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.remove(str(repo))
+
+
+class ModelRegistry:
+    """
+    Lazily loads and shares the detection, depth and appearance-embedding models.
+
+    Nothing is loaded at import time: each model is loaded on first use, or all
+    at once through ``warm_up`` (called from the FastAPI lifespan). Weights are
+    read from ``weights_dir`` when present; the hub/network is only used as a
+    fallback. Load times are recorded per model in ``load_times``.
+
+    ``backend`` selects how YOLO and MiDaS run (see inference.py); the
+    embedder and tracker are the same for every backend.
+    """
+
+    def __init__(
+        self,
+        weights_dir=WEIGHTS_DIR,
+        backend=INFERENCE_BACKEND,
+        quantize=ONNX_QUANTIZE,
+        intra_op_threads=INTRA_OP_THREADS,
+        inter_op_threads=INTER_OP_THREADS,
+    ):
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend {backend!r}; expected one of {INFERENCE_BACKENDS}.")
+        self.weights_dir = Path(weights_dir)
+        self.backend = backend
+        self.quantize = quantize
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        # ONNX Runtime sessions run on the CPU, so their inputs stay there
+        use_cuda = backend == "torch" and torch.cuda.is_available()
+        self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.load_times = {}
+        self._models = {}
+        self._factories = {}
+        self._lock = threading.RLock()
+        self._idle_yolos = None  # YOLO instances free for borrow_yolo, seeded with ``yolo``
+
+    def _get(self, name, loader):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            if name not in self._models:
+                start = time.perf_counter()
+                self._models[name] = self._factories.get(name, loader)()
+                self.load_times[name] = time.perf_counter() - start
+                logging.info(f"Loaded {name} in {self.load_times[name]:.2f}s")
+            return self._models[name]
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def override(self, name, factory):
+        """
+        Replace how a model is built, e.g. with a stub in benchmarks.
+
+        Args:
+            name (str): "yolo", "midas", "midas_transform" or "embedder".
+            factory (callable): Returns the replacement; for "yolo" it also backs ``new_yolo``.
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._models.pop(name, None)
+            self.load_times.pop(name, None)
+            if name == "yolo":
+                self._idle_yolos = None
+
+    @property
+    def yolo(self):
+        return self._get("yolo", self.new_yolo)
+
+    @property
+    def midas(self):
+        return self._get("midas", self._load_midas)
+
+    @property
+    def midas_transform(self):
+        return self._get("midas_transform", self._load_midas_transform)
+
+    @property
+    def embedder(self):
+        return self._get("embedder", self._load_embedder)
+
+    @contextlib.contextmanager
+    def borrow_yolo(self):
+        """
+        Lend a YOLO instance to the calling thread for the duration of a call.
+
+        The ultralytics predictor is not thread-safe, so concurrent callers get
+        separate instances. Returned instances stay in a per-process pool that
+        later pipeline threads and jobs reuse, so the pool only grows to the
+        highest number of concurrent callers and nothing is reloaded per run.
+        ONNX Runtime sessions are thread-safe, so the onnx backend shares ``yolo``.
+
+        Yields:
+            A model called like ultralytics YOLO.
+        """
+        if self.backend == "onnx" and "yolo" not in self._factories:
+            yield self.yolo
+            return
+        with self._lock:
+            if self._idle_yolos is None:
+                self._idle_yolos = [self.yolo]
+            yolo = self._idle_yolos.pop() if self._idle_yolos else None
+        if yolo is None:
+            yolo = self.new_yolo()
+        try:
+            yield yolo
+        finally:
+            with self._lock:
+                if self._idle_yolos is not None:
+                    self._idle_yolos.append(yolo)
+
+    def new_yolo(self):
+        """
+        Build a fresh YOLO instance; borrow_yolo adds these to its pool as needed.
+        """
+        if "yolo" in self._factories:
+            return self._factories["yolo"]()
+        if self.backend == "onnx":
+            path = self._onnx_graph(YOLO_ONNX, lambda path: export_yolo(self._new_eager_yolo(), path))
+            return OnnxYolo(path, self.intra_op_threads, self.inter_op_threads)
+        return self._new_eager_yolo()
+
+    def _new_eager_yolo(self):
+        from ultralytics import YOLO
+
+        local_weights = self.weights_dir / YOLO_WEIGHTS
+        return YOLO(str(local_weights) if local_weights.exists() else YOLO_WEIGHTS)
+
+    def _onnx_graph(self, name, export):
+        """
+        Path of an exported graph (its int8 copy when quantizing), exporting
+        and quantizing it into the weights directory if missing.
+        """
+        path = self.weights_dir / name
+        with self._lock:
+            if not path.exists():
+                logging.warning(f"{path} not found; exporting it from the eager model.")
+                self.weights_dir.mkdir(parents=True, exist_ok=True)
+                export(path)
+            if not self.quantize:
+                return path
+            quantized_path = self.weights_dir / quantized_name(name)
+            if not quantized_path.exists():
+                quantize(path, quantized_path)
+            return quantized_path
+
+    def _midas_repo(self):
+        repo = self.weights_dir / MIDAS_REPO
+        return repo if (repo / "hubconf.py").exists() else None
+
+    def _load_midas(self):
+        if self.backend == "onnx":
+            path = self._onnx_graph(MIDAS_ONNX, lambda path: export_midas(self._load_eager_midas(), path))
+            return OnnxMidas(path, self.intra_op_threads, self.inter_op_threads)
+        return self._load_eager_midas()
+
+    def _load_eager_midas(self):
+        repo = self._midas_repo()
+        local_weights = self.weights_dir / MIDAS_WEIGHTS
+        if repo is not None and local_weights.exists():
+            # MidasNet_small fetches its backbone code through torch.hub; pointing the hub
+            # directory at the weights directory makes it use the local checkout
+            if not (self.weights_dir / GEN_EFFICIENTNET_REPO / "hubconf.py").exists():
+                logging.warning(f"{GEN_EFFICIENTNET_REPO} not found in {self.weights_dir}; fetching it from GitHub.")
+            torch.hub.set_dir(str(self.weights_dir))
+            MidasNet_small = _import_from_repo(repo, "midas.midas_net_custom").MidasNet_small
+            # Same arguments as hubconf's MiDaS_small; given a weights path, the backbone
+            # is built without downloading its ImageNet weights
+            midas = MidasNet_small(
+                str(local_weights),
+                features=64,
+                backbone="efficientnet_lite3",
+                exportable=True,
+                non_negative=True,
+                blocks={"expand": True},
+            )
+        else:
+            logging.warning(f"MiDaS weights not found in {self.weights_dir}; loading from torch hub.")
+            midas = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
+        return midas.eval().to(self.device)
+
+    def _load_midas_transform(self):
+        repo = self._midas_repo()
+        if repo is not None:
+            midas_transforms = torch.hub.load(str(repo), "transforms", source="local")
+        else:
+            midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
+        return midas_transforms.small_transform
+
+    def _load_embedder(self):
+        from deep_sort_realtime.embedder.embedder_pytorch import MobileNetv2_Embedder
+
+        use_gpu = self.device.type == "cuda"
+        return MobileNetv2_Embedder(half=use_gpu, max_batch_size=16, bgr=True, gpu=use_gpu)
+
+    def new_tracker(self):
+        """
+        Build a DeepSort tracker for a single job.
+
+        Tracker state (track IDs, Kalman filters, appearance gallery) is per job;
+        appearance embeddings come from the shared ``embedder`` and are passed to
+        ``update_tracks`` explicitly.
+        """
+        from deep_sort_realtime.deepsort_tracker import DeepSort
+
+        return DeepSort(max_age=30, n_init=3, nn_budget=100, embedder=None)
+
+    def model_versions(self):
+        """
+        Identify the weights and libraries in use without loading any model.
+
+        Returns:
+            dict: Version string per weights file and package.
+        """
+        versions = {"inference_backend": self.backend}
+        weights = [YOLO_WEIGHTS, MIDAS_WEIGHTS]
+        packages = ["ultralytics", "torch", "deep-sort-realtime"]
+        if self.backend == "onnx":
+            weights = [quantized_name(name) if self.quantize else name for name in (YOLO_ONNX, MIDAS_ONNX)]
+            packages.append("onnxruntime")
+        for name in weights:
+            path = self.weights_dir / name
+            if path.exists():
+                stat = path.stat()
+                versions[name] = f"{stat.st_size}-{int(stat.st_mtime)}"
+            else:
+                versions[name] = "hub" if self.backend == "torch" else "unexported"
+        for package in packages:
+            try:
+                versions[package] = importlib.metadata.version(package)
+            except importlib.metadata.PackageNotFoundError:
+                versions[package] = None
+        return versions
+
+    def warm_up(self):
+        """
+        Load every model up front.
+
+        Returns:
+            dict: Load time in seconds per model.
+        """
+        start = time.perf_counter()
+        self.yolo
+        self.midas
+        self.midas_transform
+        self.embedder
+        logging.info(f"Model warm-up finished in {time.perf_counter() - start:.2f}s")
+        return dict(self.load_times)
+
+
+# Shared by every DanceFormationGenerator in the process
+registry = ModelRegistry()
@@ -0,0 +1,214 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# Marks the end of a stream on a queue
+_END = object()
+
+
+class PipelineStats:
+    """
+    Thread-safe per-stage timing and queue depth counters.
+
+    Every recorded timing is also passed to each of ``listeners`` as
+    ``listener(stage, elapsed)``, which is how metrics and profilers hook into
+    a run. Listeners are called on the recording thread and must be thread-safe.
+    """
+
+    def __init__(self, listeners=()):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.queues = {}
+        self.listeners = list(listeners)
+
+    def record(self, stage, elapsed):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_seconds"] += elapsed
+            entry["max_seconds"] = max(entry["max_seconds"], elapsed)
+        for listener in self.listeners:
+            listener(stage, elapsed)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def sample_queue(self, name, depth):
+        with self._lock:
+            entry = self.queues.setdefault(name, {"depth": 0, "max_depth": 0, "samples": 0, "total_depth": 0})
+            entry["depth"] = depth
+            entry["max_depth"] = max(entry["max_depth"], depth)
+            entry["samples"] += 1
+            entry["total_depth"] += depth
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Per-stage count/total/mean/max seconds and per-queue current/max/mean depth.
+        """
+        with self._lock:
+            stages = {
+                stage: {
+                    **entry,
+                    "mean_seconds": entry["total_seconds"] / entry["count"] if entry["count"] else 0.0,
+                }
+                for stage, entry in self.stages.items()
+            }
+            queues = {
+                name: {
+                    "depth": entry["depth"],
+                    "max_depth": entry["max_depth"],
+                    "mean_depth": entry["total_depth"] / entry["samples"] if entry["samples"] else 0.0,
+                }
+                for name, entry in self.queues.items()
+            }
+        return {"stages": stages, "queues": queues}
+
+
+class PipelineEngine:
+    """
+    Producer-consumer engine overlapping decode, inference and ordered tracking.
+
+    A decoder thread pulls items from ``source`` and groups them into batches on
+    a bounded queue. A pool of inference threads runs ``infer`` on each batch.
+    ``run`` yields ``(item, result)`` pairs back on the calling thread strictly in
+    source order, so stateful stages such as tracking can consume them directly.
+    The number of batches in flight is capped, so memory stays bounded even if
+    one inference worker falls behind.
+    """
+
+    def __init__(self, source, infer, batch_size=1, num_workers=2, queue_size=4, stats=None):
+        """
+        Args:
+            source (iterable): Items to process, e.g. (frame_count, frame) tuples.
+            infer (callable): Maps a list of items to a list of results of the same length.
+            batch_size (int): Items per inference call.
+            num_workers (int): Number of inference threads.
+            queue_size (int): Maximum number of batches waiting between stages.
+            stats (PipelineStats or None): Where to record stage timings; a new one when None.
+        """
+        self.source = source
+        self.infer = infer
+        self.batch_size = max(1, batch_size)
+        self.num_workers = max(1, num_workers)
+        self.queue_size = max(1, queue_size)
+        self.stats = stats if stats is not None else PipelineStats()
+        self._decoded = queue.Queue(maxsize=self.queue_size)
+        self._inferred = queue.Queue()
+        # Bounds batches between the decoder and the ordered consumer
+        self._in_flight = threading.BoundedSemaphore(self.queue_size + self.num_workers)
+        self._stop = threading.Event()
+
+    def _put(self, target, value):
+        """
+        Put on a bounded queue, giving up if the engine is stopping.
+        """
+        while not self._stop.is_set():
+            try:
+                target.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _acquire_slot(self):
+        while not self._stop.is_set():
+            if self._in_flight.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _decode_loop(self):
+        sequence = 0
+        items = iter(self.source)
+        try:
+            while not self._stop.is_set():
+                if not self._acquire_slot():
+                    break
+                batch = []
+                with self.stats.timer("decode"):
+                    for item in items:
+                        batch.append(item)
+                        if len(batch) == self.batch_size:
+                            break
+                if not batch:
+                    self._in_flight.release()
+                    break
+                if not self._put(self._decoded, (sequence, batch)):
+                    break
+                self.stats.sample_queue("decoded", self._decoded.qsize())
+                sequence += 1
+        except Exception as e:
+            logging.exception("Pipeline decoder failed")
+            self._inferred.put((None, e, None))
+        finally:
+            for _ in range(self.num_workers):
+                self._put(self._decoded, _END)
+
+    def _infer_loop(self):
+        while True:
+            try:
+                task = self._decoded.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+                continue
+            if task is _END:
+                break
+            sequence, batch = task
+            try:
+                with self.stats.timer("inference"):
+                    results = self.infer(batch)
+            except Exception as e:
+                logging.exception("Pipeline inference worker failed")
+                self._inferred.put((None, e, None))
+                break
+            self._inferred.put((sequence, batch, results))
+            self.stats.sample_queue("inferred", self._inferred.qsize())
+        self._inferred.put(_END)
+
+    def run(self):
+        """
+        Start the decoder and inference threads and yield results in source order.
+
+        Yields:
+            tuple: (item, result) for every source item.
+        """
+        threads = [threading.Thread(target=self._decode_loop, name="pipeline-decode", daemon=True)]
+        threads += [
+            threading.Thread(target=self._infer_loop, name=f"pipeline-infer-{i}", daemon=True)
+            for i in range(self.num_workers)
+        ]
+        for thread in threads:
+            thread.start()
+        pending = {}
+        next_sequence = 0
+        workers_done = 0
+        try:
+            while workers_done < self.num_workers or next_sequence in pending:
+                if next_sequence in pending:
+                    batch, results = pending.pop(next_sequence)
+                    next_sequence += 1
+                    for item, result in zip(batch, results):
+                        yield item, result
+                    self._in_flight.release()
+                    continue
+                message = self._inferred.get()
+                if message is _END:
+                    workers_done += 1
+                    continue
+                sequence, batch, results = message
+                if sequence is None:
+                    # An upstream stage failed; `batch` carries the exception
+                    raise batch
+                pending[sequence] = (batch, results)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
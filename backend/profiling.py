@@ -0,0 +1,110 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+# Functions listed in a cProfile report
+PROFILE_TOP_FUNCTIONS = 60
+
+
+class Profiler:
+    """
+    Base class for profilers attached to a single job.
+
+    A job's worker calls ``start`` before the pipeline runs and ``stop`` after
+    it; ``on_stage`` receives every stage timing in between (from any pipeline
+    thread). ``stop`` returns the text report kept on the job.
+    """
+
+    def start(self):
+        pass
+
+    def on_stage(self, stage, elapsed):
+        pass
+
+    def stop(self):
+        return ""
+
+
+class CProfileProfiler(Profiler):
+    """
+    cProfile over the job's calling thread, reported by cumulative time.
+
+    Only the thread that runs the job is profiled, so with pipelined inference
+    (KADA_INFERENCE_WORKERS > 0) detection and depth time happens elsewhere.
+    """
+
+    def __init__(self, top=PROFILE_TOP_FUNCTIONS):
+        self.top = top
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        output = io.StringIO()
+        pstats.Stats(self._profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        return output.getvalue()
+
+
+class StageTraceProfiler(Profiler):
+    """
+    Per-stage latency summary for one job, including the pipeline threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def on_stage(self, stage, elapsed):
+        with self._lock:
+            self._stages.setdefault(stage, []).append(elapsed)
+
+    def stop(self):
+        wall = time.perf_counter() - self._start
+        lines = [f"wall {wall:.3f}s", f"{'stage':<12}{'count':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: -sum(item[1]))
+        for stage, timings in stages:
+            timings = sorted(timings)
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            lines.append(
+                f"{stage:<12}{len(timings):>8}{sum(timings):>10.3f}{1000 * sum(timings) / len(timings):>10.2f}"
+                f"{1000 * p95:>10.2f}{1000 * timings[-1]:>10.2f}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+# Profilers selectable per job by name
+PROFILERS = {
+    "cprofile": CProfileProfiler,
+    "stages": StageTraceProfiler,
+}
+
+
+def register_profiler(name, factory):
+    """
+    Make a Profiler factory selectable by name for new jobs.
+
+    Jobs run in spawned worker processes, so register at import time of a
+    module those processes import as well.
+    """
+    PROFILERS[name] = factory
+
+
+def new_profiler(name):
+    """
+    Raises:
+        ValueError: If no profiler is registered under name.
+    """
+    try:
+        factory = PROFILERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown profiler {name!r}; expected one of {sorted(PROFILERS)}.") from None
+    return factory()
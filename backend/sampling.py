@@ -0,0 +1,152 @@
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Mean absolute grayscale change (0-1) since the last keyframe, within the dancers'
+# regions, that triggers a new one
+MOTION_THRESHOLD = float(os.environ.get("KADA_MOTION_THRESHOLD", "0.02"))
+# Longest run of sampled frames handled by tracker prediction alone
+MAX_KEYFRAME_GAP = int(os.environ.get("KADA_MAX_KEYFRAME_GAP", "6"))
+# Width of the thumbnail used for frame differencing
+THUMBNAIL_WIDTH = 64
+# Fraction of a tracked box's size added on each side of its motion region
+REGION_MARGIN = 0.5
+
+
+def keyframe_step(frame_interval):
+    """
+    Frame step used for motion sampling: the largest proper divisor of frame_interval,
+    so sampling runs at least twice as often as output is emitted while still
+    landing on every emitted frame.
+    """
+    for step in range(frame_interval // 2, 0, -1):
+        if frame_interval % step == 0:
+            return step
+    return 1
+
+
+class MotionSampler:
+    """
+    Decides which sampled frames are keyframes that get full detection and depth.
+
+    The motion signal is the mean absolute difference between a small grayscale
+    thumbnail of the frame and the one of the last keyframe, taken over the
+    regions set with ``set_regions`` (the tracked dancers' boxes, grown by
+    ``REGION_MARGIN``) so small dancers on a static stage are not averaged away
+    by the background. Without regions the whole frame is used. Frames below
+    ``threshold`` are skipped (the tracker's Kalman prediction fills them in)
+    unless ``max_gap`` frames have passed since the last keyframe.
+
+    With ``time_budget`` set, the sampler also enforces a minimum gap between
+    keyframes so that the projected cost of the remaining keyframes, measured
+    from the wall-clock cost of the keyframes so far, fits in the remaining
+    budget. This trades accuracy for latency explicitly.
+    """
+
+    def __init__(
+        self, threshold=MOTION_THRESHOLD, max_gap=MAX_KEYFRAME_GAP, time_budget=None, total_samples=None
+    ):
+        """
+        Args:
+            threshold (float): Motion level (0-1) that forces a keyframe.
+            max_gap (int): Maximum sampled frames between keyframes, outside budget mode.
+            time_budget (float or None): Seconds allowed for the whole clip.
+            total_samples (int or None): Expected number of sampled frames, needed for budget mode.
+        """
+        self.threshold = threshold
+        self.max_gap = max(1, max_gap)
+        self.time_budget = time_budget
+        self.total_samples = total_samples
+        self.samples = 0
+        self.keyframes = 0
+        self._gap = 0
+        self._last_thumbnail = None
+        self._start = None
+        self._regions = None  # (boxes, frame width, frame height)
+
+    def set_regions(self, boxes, frame_shape):
+        """
+        Restrict the motion signal to these boxes from now on.
+
+        Called by the tracking stage after each keyframe; with pipelined
+        inference the boxes may lag a few sampled frames behind, which the
+        margin absorbs.
+
+        Args:
+            boxes (list): [x1, y1, x2, y2] boxes in frame pixels; empty means the whole frame.
+            frame_shape (tuple): Shape of the frames the boxes belong to.
+        """
+        frame_height, frame_width = frame_shape[:2]
+        self._regions = (np.array(boxes, dtype=np.float64).reshape(-1, 4), frame_width, frame_height)
+
+    def _motion_mask(self, thumbnail_shape):
+        regions = self._regions
+        if regions is None or not len(regions[0]):
+            return None
+        boxes, frame_width, frame_height = regions
+        height, width = thumbnail_shape
+        size = boxes[:, 2:] - boxes[:, :2]
+        grown = np.concatenate([boxes[:, :2] - size * REGION_MARGIN, boxes[:, 2:] + size * REGION_MARGIN], axis=1)
+        grown *= [width / frame_width, height / frame_height, width / frame_width, height / frame_height]
+        mask = np.zeros(thumbnail_shape, dtype=bool)
+        for x1, y1, x2, y2 in grown:
+            x1, y1 = max(int(np.floor(x1)), 0), max(int(np.floor(y1)), 0)
+            x2, y2 = min(int(np.ceil(x2)), width), min(int(np.ceil(y2)), height)
+            mask[y1:y2, x1:x2] = True
+        return mask if mask.any() else None
+
+    def _thumbnail(self, frame):
+        frame_height, frame_width = frame.shape[:2]
+        height = max(1, round(frame_height * THUMBNAIL_WIDTH / frame_width))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def _budget_gap(self):
+        """
+        Minimum keyframe gap that keeps the projected cost inside the time budget.
+        """
+        if self.time_budget is None or not self.total_samples or not self.keyframes:
+            return 1
+        elapsed = time.perf_counter() - self._start
+        remaining_time = self.time_budget - elapsed
+        remaining_samples = max(self.total_samples - self.samples, 1)
+        if remaining_time <= 0:
+            return remaining_samples
+        cost_per_keyframe = elapsed / self.keyframes
+        affordable_keyframes = max(remaining_time / cost_per_keyframe, 1)
+        return max(1, math.ceil(remaining_samples / affordable_keyframes))
+
+    def is_keyframe(self, frame):
+        """
+        Args:
+            frame (np.ndarray): BGR sampled frame, in decode order.
+
+        Returns:
+            bool: True if the frame should get full detection and depth.
+        """
+        if self._start is None:
+            self._start = time.perf_counter()
+        self.samples += 1
+        thumbnail = self._thumbnail(frame)
+        if self._last_thumbnail is None or thumbnail.shape != self._last_thumbnail.shape:
+            keyframe = True
+        else:
+            self._gap += 1
+            budget_gap = self._budget_gap()
+            if self._gap < budget_gap:
+                keyframe = False
+            elif self._gap >= max(self.max_gap, budget_gap):
+                keyframe = True
+            else:
+                difference = np.abs(thumbnail - self._last_thumbnail)
+                mask = self._motion_mask(thumbnail.shape)
+                motion = float(np.mean(difference if mask is None else difference[mask])) / 255
+                keyframe = motion > self.threshold
+        if keyframe:
+            self._last_thumbnail = thumbnail
+            self._gap = 0
+            self.keyframes += 1
+        return keyframe
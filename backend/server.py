@@ -1,22 +1,51 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from typing import Literal, Optional
 import os
-import uuid
-import yt_dlp
-import subprocess
 from fastapi.middleware.cors import CORSMiddleware
-from pathlib import Path
 import asyncio
+import json
 import logging
-from main import DanceFormationAPI  # Assuming main.py is in the same directory
-
-app = FastAPI()
+from contextlib import asynccontextmanager
+from cache import FormationCache, link_or_copy
+from decoding import is_partial
+from ingest import start_download
+from jobs import JobManager, JobQueueFull
+from media import IMMUTABLE_CACHE_CONTROL, MEDIA_CLEANUP_INTERVAL, cleanup_media, media_path, new_media_path
+from metrics import metrics
+from timeline import PositionTimeline
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the job worker pool and the media cleanup loop. Workers warm up their
+    models in the background, so the API (and health checks) are available immediately.
+    """
+    await job_manager.start()
+    cleanup_task = asyncio.create_task(clean_media_periodically())
+    yield
+    cleanup_task.cancel()
+    await job_manager.shutdown()
+
+async def clean_media_periodically():
+    """
+    Deletes old job videos from the media directory, keeping those of unfinished jobs.
+    """
+    while True:
+        in_use = [job.video_path for job in job_manager.jobs.values() if not job.done]
+        try:
+            await asyncio.to_thread(cleanup_media, in_use)
+        except OSError as e:
+            logger.warning(f"Media cleanup failed: {e}")
+        await asyncio.sleep(MEDIA_CLEANUP_INTERVAL)
+
+app = FastAPI(lifespan=lifespan)
+
 # CORS configuration
 origins = [
     "http://localhost",
@@ -35,91 +64,88 @@ app.add_middleware(
 class ProcessVideoRequest(BaseModel):
     query: str
     num_dancers: int = 5
-    duration: int = 40  # Duration in seconds
+    # Duration in seconds; None processes the full video (long videos are split into parallel chunks)
+    duration: Optional[int] = 40
+    # "coordinates" returns per-dancer sub-cell positions instead of grid matrices
+    output_format: Literal["matrix", "coordinates"] = "matrix"
+    # Name of a profiler to run this job under, e.g. "cprofile" or "stages"
+    profile: Optional[str] = None
 
 async def download_video(query, duration=7):
     """
-    Downloads the video using yt-dlp based on the query and trims it to the specified duration.
-    Returns the path to the trimmed video file.
+    Starts downloading the first `duration` seconds of the video (all of it when None)
+    in a format capped at INGEST_MAX_HEIGHT. The file is fragmented MP4 that the
+    pipeline decodes while it is still arriving.
+    Returns (video path, video ID, download) or (None, None, None).
     """
-    unique_filename = f'{uuid.uuid4()}'
-    output_filename = f'{unique_filename}_trimmed.mp4'
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best',
-        'noplaylist': True,
-        'outtmpl': f'{unique_filename}.%(ext)s',
-        'quiet': True,
-    }
-    def run_yt_dlp():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            try:
-                search_query = f"ytsearch1:{query}"
-                result = ydl.extract_info(search_query, download=True)
-                if 'entries' in result:
-                    video = result['entries'][0]
-                else:
-                    video = result
-                video_filename = ydl.prepare_filename(video)
-
-                # Trim the video using FFmpeg
-                trimmed_video_filename = output_filename
-                trim_command = [
-                    'ffmpeg', '-y', '-i', video_filename, '-t', str(duration),
-                    '-c', 'copy', trimmed_video_filename
-                ]
-                subprocess.run(trim_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-                # Remove the original downloaded video
-                os.remove(video_filename)
-
-                return trimmed_video_filename
-            except Exception as e:
-                logger.error(f"Error downloading or trimming video: {e}")
-                return None
-
-    return await asyncio.to_thread(run_yt_dlp)
-
-async def process_video_and_get_positions(video_path, num_dancers, duration):
-    """
-    Processes the video to generate position matrices.
-    """
-    api = DanceFormationAPI(num_dancers)
+    output_filename = str(new_media_path())
     try:
-        output_data = api.process_video_and_get_positions(video_path, duration=duration)
-        return output_data
+        download = await asyncio.to_thread(start_download, query, duration, output_filename)
     except Exception as e:
-        logger.error(f"Error processing video: {e}")
-        # Clean up the downloaded (trimmed) video
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        raise HTTPException(status_code=500, detail="Error processing video.")
+        logger.error(f"Error downloading video: {e}")
+        return None, None, None
+    return output_filename, download.video_id, download
 
+# Persistent cache of resolved queries, trimmed videos and position timelines
+formation_cache = FormationCache()
+# Keeps fire-and-forget tasks referenced until they finish
+background_tasks = set()
+
+async def prepare_video(query, duration):
+    """
+    Returns (video path, video ID) for a fresh local copy of the trimmed video for
+    the query, downloading it only when the query cache has no entry.
+    """
+    cached_video, video_id = await asyncio.to_thread(formation_cache.lookup_video, query, duration)
+    if cached_video is not None:
+        video_path = str(new_media_path())
+        await asyncio.to_thread(link_or_copy, cached_video, video_path)
+        # Media cleanup goes by age, so a hard link to an old cache entry starts fresh
+        os.utime(video_path)
+        logger.info(f"Query cache hit for: {query}")
+        return video_path, video_id
 
-# Limit concurrent processing to prevent server overload
-processing_semaphore = asyncio.Semaphore(2)  # Adjust the number as needed
+    video_path, video_id, download = await download_video(query, duration=duration)
+    if video_path and video_id:
+        # Processing starts right away; the video is cached once it has fully arrived
+        task = asyncio.create_task(cache_downloaded_video(query, duration, video_id, download))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return video_path, video_id
 
-@app.post("/api/process-video")
-async def process_video(request: ProcessVideoRequest):
+async def cache_downloaded_video(query, duration, video_id, download):
     """
-    Processes a video based on the song query and returns position matrices.
+    Stores a finished download in the query cache; failed downloads are not cached.
+    The download has already been remuxed with +faststart in place, so both the
+    job's video and later cache hits are regular MP4s that browsers can seek.
     """
-    query = request.query
-    num_dancers = request.num_dancers
-    duration = request.duration
-    logger.info(f"Processing query: {query} for {duration} seconds with {num_dancers} dancers")
+    if not await asyncio.to_thread(download.wait):
+        return
+    try:
+        await asyncio.to_thread(formation_cache.store_video, query, duration, video_id, download.path)
+    except OSError as e:
+        logger.warning(f"Could not cache video for query {query}: {e}")
+
+# Video processing runs on a pool of pre-warmed worker processes
+job_manager = JobManager(prepare_video, cache=formation_cache)
 
-    async with processing_semaphore:
-        # Step 1: Download and trim the video using yt-dlp and FFmpeg
-        video_path = await download_video(query, duration=duration)
-        if not video_path or not os.path.exists(video_path):
-            raise HTTPException(status_code=500, detail="Video could not be downloaded.")
+def build_positions_response(job):
+    """
+    Builds the process-video response body for a completed job.
+    """
+    # Construct the local video URL
+    video_url = f"/videos/{os.path.basename(job.video_path)}"
 
-        # Step 2: Process the video to generate position matrices
-        output_data = await process_video_and_get_positions(video_path, num_dancers, duration)
+    if job.output_format == "coordinates":
+        timeline = PositionTimeline.from_entries(job.result, job.num_dancers)
+        return {
+            "song": job.query,
+            "timeline": timeline.to_dict(),
+            "video_url": video_url,
+        }
 
-    # Step 3: Prepare the positions data
     positions = []
-    for entry in output_data:
+    for entry in job.result:
         try:
             timestamp = entry['timestamp']
             position_matrix = entry['position_matrix']
@@ -128,31 +154,173 @@ async def process_video(request: ProcessVideoRequest):
             logger.error(f"Error parsing output data at entry {entry}: {e}")
             continue  # Skip invalid entries
 
-    # Construct the local video URL
-    video_url = f"/videos/{os.path.basename(video_path)}"
-
-    # Return the response
-    response = {
-        "song": query,
+    return {
+        "song": job.query,
         "positions": positions,
         "video_url": video_url,
         # Optionally include artist or other metadata
         # "artist": artist_name,
     }
 
-    logger.info(f"Processing completed for query: {query}")
-    return response
+def submit_job(request: ProcessVideoRequest):
+    logger.info(f"Processing query: {request.query} for {request.duration} seconds with {request.num_dancers} dancers")
+    try:
+        return job_manager.submit(
+            request.query, request.num_dancers, request.duration, request.output_format, request.profile
+        )
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="Too many videos are being processed. Try again later.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.post("/api/process-video")
+async def process_video(request: ProcessVideoRequest):
+    """
+    Processes a video based on the song query and returns position matrices.
+    Waits for the job to finish; use /api/jobs to poll or stream progress instead.
+    """
+    job = submit_job(request)
+    await job_manager.wait(job)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error or "Error processing video.")
+
+    logger.info(f"Processing completed for query: {request.query}")
+    return build_positions_response(job)
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(request: ProcessVideoRequest):
+    """
+    Queues a video for processing and returns its job id immediately.
+    """
+    job = submit_job(request)
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Returns the status and progress of a job.
+    """
+    return get_job_or_404(job_id).to_dict()
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    Returns the position matrices of a completed job.
+    """
+    job = get_job_or_404(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error or "Error processing video.")
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}.")
+    return build_positions_response(job)
+
+@app.get("/api/jobs/{job_id}/timeline")
+async def get_job_timeline(job_id: str, format: Literal["npz", "json"] = "npz"):
+    """
+    Returns the per-dancer coordinate timeline of a completed "coordinates" job,
+    either as a delta-encoded .npz archive or as columnar JSON.
+    """
+    job = get_job_or_404(job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}.")
+    if job.output_format != "coordinates":
+        raise HTTPException(status_code=409, detail="Timelines are only available for the coordinates output format.")
+    timeline = PositionTimeline.from_entries(job.result, job.num_dancers)
+    if format == "json":
+        return timeline.to_dict()
+    return Response(
+        content=await asyncio.to_thread(timeline.to_npz),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{job.id}.npz"'},
+    )
+
+@app.get("/api/jobs/{job_id}/profile", response_class=PlainTextResponse)
+async def get_job_profile(job_id: str):
+    """
+    Returns the profiler report of a completed job submitted with "profile".
+    """
+    job = get_job_or_404(job_id)
+    if job.profile is None:
+        raise HTTPException(status_code=404, detail="Job was not profiled.")
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}.")
+    if job.profile_report is None:
+        raise HTTPException(status_code=404, detail="Job result came from the cache; no profile was recorded.")
+    return job.profile_report
+
+@app.get("/api/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    """
+    Streams job status and progress as server-sent events until the job finishes.
+    """
+    job = get_job_or_404(job_id)
+
+    async def event_stream():
+        async for update in job_manager.iter_updates(job):
+            if update is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {update['status']}\ndata: {json.dumps(update)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/api/jobs/{job_id}/positions")
+async def stream_job_positions(job_id: str):
+    """
+    Streams {timestamp, position_matrix} entries as NDJSON while the job runs,
+    so formations can be rendered before the whole video is processed.
+    A final {"error": ...} line is sent if the job fails.
+    """
+    job = get_job_or_404(job_id)
+
+    async def ndjson_stream():
+        async for entry in job_manager.iter_positions(job):
+            yield json.dumps(entry) + "\n"
+        if job.status == "failed":
+            yield json.dumps({"error": job.error or "Error processing video."}) + "\n"
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
 
 # Serve video files
 @app.get("/videos/{video_filename}")
 async def get_video(video_filename: str):
     """
-    Serves the video file.
+    Serves a job's video from the media directory. FileResponse answers Range
+    requests with 206 partial content and sets ETag and Last-Modified.
     """
-    # Prevent directory traversal attacks
-    safe_filename = os.path.basename(video_filename)
-    video_path = Path(os.getcwd()) / safe_filename
-    if not video_path.exists():
+    video_path = media_path(video_filename)
+    if video_path is None:
         raise HTTPException(status_code=404, detail="Video not found.")
 
-    return FileResponse(video_path, media_type="video/mp4")
+    # A video that is still downloading grows, so it must not be cached yet
+    cache_control = "no-cache" if is_partial(video_path) else IMMUTABLE_CACHE_CONTROL
+    return FileResponse(video_path, media_type="video/mp4", headers={"Cache-Control": cache_control})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Job counters and stage latency histograms in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    """
+    Liveness/readiness probe reporting whether the job workers have loaded their models.
+    "status" is "degraded" when a worker failed to, with the reasons in "warm_up_errors".
+    """
+    warm_up_errors = job_manager.warm_up_errors
+    return {
+        "status": "degraded" if warm_up_errors else "ok",
+        "models_ready": job_manager.ready,
+        "warm_up_errors": warm_up_errors,
+        "load_times": job_manager.load_times,
+        "pending_jobs": job_manager.pending_count(),
+        "workers": job_manager.num_workers,
+    }
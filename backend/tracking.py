@@ -0,0 +1,117 @@
+import heapq
+from collections import OrderedDict
+
+# Track-to-dancer mappings remembered after a track is gone
+TRACK_HISTORY_SIZE = 50
+# Frames without an update after which a dancer's track mapping is dropped
+STALE_FRAMES = 60
+
+
+class DancerState:
+    """
+    Last known state of one dancer number.
+
+    Attributes:
+        depth (float): Normalized depth, inf until the dancer is first seen.
+        grid_position (tuple): (grid_x, grid_y) cell.
+        position (tuple): Normalized (x, y) center in the frame.
+        last_seen (int): Frame count of the last keyframe that updated the dancer.
+    """
+
+    __slots__ = ("depth", "grid_position", "position", "last_seen")
+
+    def __init__(self, depth, grid_position, position, last_seen):
+        self.depth = depth
+        self.grid_position = grid_position
+        self.position = position
+        self.last_seen = last_seen
+
+    def __repr__(self):
+        return (
+            f"DancerState(depth={self.depth}, grid_position={self.grid_position}, "
+            f"position={self.position}, last_seen={self.last_seen})"
+        )
+
+
+class TrackHistory:
+    """
+    Least-recently-used map of track IDs to the dancer numbers they had.
+
+    Recording an assignment and evicting the oldest entry are both O(1), so the
+    history stays at ``capacity`` entries however long the video runs.
+    """
+
+    def __init__(self, capacity=TRACK_HISTORY_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+
+    def record(self, track_id, dancer_num):
+        self._entries[track_id] = dancer_num
+        self._entries.move_to_end(track_id)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def get(self, track_id, default=None):
+        return self._entries.get(track_id, default)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, track_id):
+        return track_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return self._entries.items()
+
+
+class StaleQueue:
+    """
+    Min-heap of (last_seen, dancer_num) for finding dancers not updated recently.
+
+    ``touch`` pushes a new entry instead of updating the old one in place;
+    superseded entries are skipped when they reach the top. Entries only
+    reach the top once they are older than the stale window, so the heap holds
+    about one window of updates and ``pop_stale`` costs O(log n) per expired
+    entry instead of a scan over every dancer each frame.
+    """
+
+    def __init__(self, stale_frames=STALE_FRAMES):
+        self.stale_frames = stale_frames
+        self._heap = []
+        self._last_seen = {}
+
+    def touch(self, dancer_num, frame_count):
+        if self._last_seen.get(dancer_num) == frame_count:
+            return
+        self._last_seen[dancer_num] = frame_count
+        heapq.heappush(self._heap, (frame_count, dancer_num))
+
+    def pop_stale(self, current_frame):
+        """
+        Remove and return dancers whose last update is more than stale_frames old.
+
+        Each dancer is returned once per period of staleness; touching it again
+        makes it eligible again.
+
+        Returns:
+            list: Dancer numbers, oldest first.
+        """
+        stale = []
+        cutoff = current_frame - self.stale_frames
+        heap = self._heap
+        while heap and heap[0][0] < cutoff:
+            last_seen, dancer_num = heapq.heappop(heap)
+            if self._last_seen.get(dancer_num) == last_seen:
+                del self._last_seen[dancer_num]
+                stale.append(dancer_num)
+        return stale
+
+    def clear(self):
+        self._heap.clear()
+        self._last_seen.clear()
+
+    def __len__(self):
+        return len(self._heap)